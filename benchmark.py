@@ -0,0 +1,443 @@
+"""Benchmarks for the TRAC-2 preprocessing and inference pipeline.
+
+    python benchmark.py ingest --data_dir ./
+    python benchmark.py featurize --data_dir ./ \
+        --model_name_or_path bert-base-multilingual-uncased --do_lower_case
+    python benchmark.py models --data_dir ./ \
+        --model_name_or_path trained-model --do_lower_case --quantize
+    python benchmark.py early_exit --data_dir ./ \
+        --model_name_or_path trained-model --do_lower_case
+    python benchmark.py finetune --output_dirs full-model lora-model
+"""
+
+import argparse
+import copy
+import io
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from sklearn.metrics import f1_score
+from transformers import WEIGHTS_NAME, BertTokenizer, BertTokenizerFast
+
+from predict import load_model, predict_chunk
+from run_classification import ADAPTER_WEIGHTS_NAME
+
+from trac_dataloader import (
+    DynamicPaddingCollator,
+    InputExample,
+    TracProcessor,
+    convert_examples_to_features,
+)
+
+
+def _timeit(fn, repeat):
+    """Returns the best wall time of `repeat` calls and the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _get_examples_iterrows(data_dir, set_type, folder):
+    """The original row-by-row loader, kept as the ingestion baseline."""
+    examples = []
+    df = pd.read_csv(f"{data_dir}/{folder}/trac2_{folder}_{set_type}.csv")
+    for _, row in df.iterrows():
+        examples.append(
+            InputExample(
+                guid=row["ID"],
+                text=row["Text"],
+                label_a=row.get("Sub-task A"),
+                label_b=row.get("Sub-task B"),
+                language=folder,
+            )
+        )
+    return examples
+
+
+def benchmark_ingest(args):
+    processor = TracProcessor(args.folder_list)
+    results = []
+    for folder in processor.folder_list:
+        for set_type in args.splits:
+            dataset_file = (
+                f"{args.data_dir}/{folder}/trac2_{folder}_{set_type}.csv"
+            )
+            if not os.path.exists(dataset_file):
+                continue
+            iterrows_time, baseline = _timeit(
+                lambda: _get_examples_iterrows(
+                    args.data_dir, set_type, folder
+                ),
+                args.repeat,
+            )
+            columnar_time, examples = _timeit(
+                lambda: processor.get_examples(
+                    args.data_dir, set_type, [folder]
+                ),
+                args.repeat,
+            )
+            assert examples == baseline, "columnar examples differ"
+            results.append(
+                {
+                    "language": folder,
+                    "split": set_type,
+                    "rows": len(examples),
+                    "iterrows_s": iterrows_time,
+                    "columnar_s": columnar_time,
+                    "speedup": iterrows_time / columnar_time,
+                }
+            )
+            print(json.dumps(results[-1]))
+    return results
+
+
+def benchmark_featurize(args):
+    processor = TracProcessor(args.folder_list)
+    examples = processor.get_examples(args.data_dir, args.split)
+    results = {"examples": len(examples)}
+    features = {}
+    for name, tokenizer_class in (
+        ("python", BertTokenizer),
+        ("fast", BertTokenizerFast),
+    ):
+        tokenizer = tokenizer_class.from_pretrained(
+            args.model_name_or_path, do_lower_case=args.do_lower_case
+        )
+        results[name + "_s"], features[name] = _timeit(
+            lambda: convert_examples_to_features(
+                examples,
+                tokenizer,
+                label_list=processor.get_labels(),
+                max_seq_length=args.max_seq_length,
+                output_mode="classification",
+            ),
+            args.repeat,
+        )
+    results["speedup"] = results["python_s"] / results["fast_s"]
+    results["mismatches"] = sum(
+        a != b for a, b in zip(features["python"], features["fast"])
+    )
+    print(json.dumps(results))
+    return results
+
+
+def model_size(model):
+    """Size in bytes of the serialized state dict of `model`, or of the
+    file it was exported to."""
+    if not isinstance(model, torch.nn.Module):
+        return os.path.getsize(model.path)
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def evaluate_languages(args, model, tokenizer):
+    """Macro-F1 of both heads and CPU throughput of `model` on the `--split`
+    set of every language."""
+    processor = TracProcessor(args.folder_list)
+    label_list = processor.get_labels()
+    collator = DynamicPaddingCollator(pad_token_id=tokenizer.pad_token_id)
+    results = {}
+    for language in processor.folder_list:
+        examples = processor.get_examples(args.data_dir, args.split, [language])
+        if not examples:
+            continue
+        elapsed, (probs_a, probs_b) = _timeit(
+            lambda: predict_chunk(
+                args, model, tokenizer, collator, label_list, examples
+            ),
+            args.repeat,
+        )
+        result = {
+            "examples_per_s": len(examples) / elapsed,
+            "ms_per_example": 1000 * elapsed / len(examples),
+        }
+        for task, probs in (("a", probs_a), ("b", probs_b)):
+            labels = [getattr(e, "label_" + task) for e in examples]
+            preds = np.array(label_list[task])[probs.argmax(axis=1)]
+            result["macro_f1_" + task] = f1_score(
+                labels, preds, average="macro"
+            )
+        results[language] = result
+    return results
+
+
+def benchmark_models(args):
+    """Dev macro-F1, throughput and size of every --model_name_or_path, and
+    of its int8 dynamically quantized version with --quantize. Listing a
+    teacher and its distilled students gives their F1/latency trade-off."""
+    args.device = torch.device("cpu")
+    args.no_fast_tokenizer = False
+    args.tokenizer_name = ""
+    args.model_type = "bert"
+    args.early_exit_threshold = 0.0
+    torch.set_num_threads(args.num_threads or torch.get_num_threads())
+    report = []
+    if args.quantize and args.backend != "pytorch":
+        raise ValueError("--quantize only applies to the pytorch backend")
+    for model_name_or_path in args.model_name_or_path:
+        model_args = copy.copy(args)
+        model_args.model_name_or_path = model_name_or_path
+        variants = [False, True] if args.quantize else [False]
+        baseline = None
+        for quantize in variants:
+            model_args.quantize = quantize
+            model, tokenizer = load_model(model_args)
+            entry = {
+                "model": model_name_or_path,
+                "backend": args.backend,
+                "dtype": "int8" if quantize else "fp32",
+                "size_mb": model_size(model) / 2 ** 20,
+                "num_hidden_layers": getattr(
+                    getattr(model, "config", None), "num_hidden_layers", None
+                ),
+                "languages": evaluate_languages(model_args, model, tokenizer),
+            }
+            if baseline is None:
+                baseline = entry
+            else:
+                for language, result in entry["languages"].items():
+                    reference = baseline["languages"][language]
+                    for key in ("macro_f1_a", "macro_f1_b"):
+                        result[key + "_delta"] = result[key] - reference[key]
+                    result["speedup"] = (
+                        result["examples_per_s"] / reference["examples_per_s"]
+                    )
+            print(json.dumps(entry))
+            report.append(entry)
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+class _ExitRecorder(object):
+    """Calls an early exit model and records how many layers every example
+    went through."""
+
+    def __init__(self, model):
+        self.model = model
+        self.exit_layers = []
+
+    def __call__(self, **inputs):
+        outputs = self.model(**inputs)
+        if len(outputs) > 3:
+            self.exit_layers.append(outputs[3].cpu().numpy())
+        else:
+            self.exit_layers.append(
+                np.full(len(outputs[1]), self.model.config.num_hidden_layers)
+            )
+        return outputs
+
+
+def benchmark_early_exit(args):
+    """Dev macro-F1, throughput and average number of encoder layers run
+    per example of a model trained with --early_exit_layers, for every
+    --thresholds value (0 runs all layers)."""
+    args.device = torch.device("cpu")
+    args.no_fast_tokenizer = False
+    args.tokenizer_name = ""
+    args.model_type = "bert"
+    args.quantize = False
+    args.backend = "pytorch"
+    args.early_exit_threshold = 0.0
+    torch.set_num_threads(args.num_threads or torch.get_num_threads())
+    model, tokenizer = load_model(args)
+    recorder = _ExitRecorder(model)
+    report = []
+    for threshold in args.thresholds:
+        model.early_exit_threshold = threshold
+        entry = {
+            "model": args.model_name_or_path,
+            "exit_layers": model.early_exit_layers,
+            "threshold": threshold,
+            "languages": {},
+        }
+        for language in TracProcessor(args.folder_list).folder_list:
+            language_args = copy.copy(args)
+            language_args.folder_list = [language]
+            recorder.exit_layers = []
+            result = evaluate_languages(language_args, recorder, tokenizer)
+            if language in result:
+                result[language]["avg_layers"] = float(
+                    np.concatenate(recorder.exit_layers).mean()
+                )
+                entry["languages"].update(result)
+        print(json.dumps(entry))
+        report.append(entry)
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def _read_eval_results(path):
+    results = {}
+    with open(path) as f:
+        for line in f:
+            key, value = line.strip().split(" = ")
+            results[key] = float(value)
+    return results
+
+
+def benchmark_finetune(args):
+    """Peak training memory against dev F1 of models trained with
+    run_classification.py (--do_train --do_eval and --logging_steps), e.g.
+    with and without --gradient_checkpointing or --lora_rank. Reads their
+    train_metrics.jsonl, eval_results.txt and saved weights."""
+    report = []
+    for output_dir in args.output_dirs:
+        training_args = torch.load(
+            os.path.join(output_dir, "training_args.bin"), weights_only=False
+        )
+        with open(os.path.join(output_dir, "train_metrics.jsonl")) as f:
+            metrics = [json.loads(line) for line in f]
+        weights = [
+            os.path.join(output_dir, name)
+            for name in (ADAPTER_WEIGHTS_NAME, WEIGHTS_NAME)
+            if os.path.exists(os.path.join(output_dir, name))
+        ]
+        entry = {
+            "output_dir": output_dir,
+            "gradient_checkpointing": getattr(
+                training_args, "gradient_checkpointing", False
+            ),
+            "lora_rank": getattr(training_args, "lora_rank", 0),
+            "batch_size": training_args.per_gpu_train_batch_size,
+            "max_seq_length": training_args.max_seq_length,
+            "saved_mb": os.path.getsize(weights[0]) / 2 ** 20,
+            "examples_per_s": float(
+                np.mean([m["examples_per_s"] for m in metrics])
+            ),
+        }
+        for key in ("max_rss_mb", "peak_gpu_memory_mb"):
+            if key in metrics[0]:
+                entry[key] = max(m[key] for m in metrics)
+        entry.update(
+            (key, value)
+            for key, value in _read_eval_results(
+                os.path.join(output_dir, "eval_results.txt")
+            ).items()
+            if key.startswith("f1")
+        )
+        print(json.dumps(entry))
+        report.append(entry)
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    ingest = subparsers.add_parser(
+        "ingest",
+        help="Compare DataFrame.iterrows and columnar CSV ingestion.",
+    )
+    ingest.add_argument("--data_dir", default="./", type=str)
+    ingest.add_argument(
+        "--folder_list", default=None, type=str, nargs="*",
+    )
+    ingest.add_argument(
+        "--splits", default=["train", "dev", "test"], type=str, nargs="*",
+    )
+    ingest.add_argument("--repeat", default=3, type=int)
+    ingest.set_defaults(func=benchmark_ingest)
+
+    featurize = subparsers.add_parser(
+        "featurize",
+        help="Compare python and fast tokenizers in featurization.",
+    )
+    featurize.add_argument("--data_dir", default="./", type=str)
+    featurize.add_argument(
+        "--model_name_or_path",
+        default="bert-base-multilingual-uncased",
+        type=str,
+    )
+    featurize.add_argument("--do_lower_case", action="store_true")
+    featurize.add_argument(
+        "--folder_list", default=None, type=str, nargs="*",
+    )
+    featurize.add_argument("--split", default="train", type=str)
+    featurize.add_argument("--max_seq_length", default=128, type=int)
+    featurize.add_argument("--repeat", default=1, type=int)
+    featurize.set_defaults(func=benchmark_featurize)
+
+    models = subparsers.add_parser(
+        "models",
+        help="Per-language dev macro-F1, CPU throughput and size of models.",
+    )
+    models.add_argument("--data_dir", default="./", type=str)
+    models.add_argument(
+        "--model_name_or_path", required=True, type=str, nargs="+",
+    )
+    models.add_argument("--do_lower_case", action="store_true")
+    models.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Also measure the int8 dynamically quantized models.",
+    )
+    models.add_argument(
+        "--backend",
+        default="pytorch",
+        choices=["pytorch", "onnx", "torchscript"],
+        help="Run the exported graphs of the models (see export.py).",
+    )
+    models.add_argument(
+        "--folder_list", default=None, type=str, nargs="*",
+    )
+    models.add_argument("--split", default="dev", type=str)
+    models.add_argument("--max_seq_length", default=128, type=int)
+    models.add_argument("--batch_size", default=32, type=int)
+    models.add_argument("--num_threads", default=0, type=int)
+    models.add_argument("--repeat", default=1, type=int)
+    models.add_argument("--output_file", default="", type=str)
+    models.set_defaults(func=benchmark_models)
+
+    early_exit = subparsers.add_parser(
+        "early_exit",
+        help="Average layers run and dev macro-F1 of early exit thresholds.",
+    )
+    early_exit.add_argument("--data_dir", default="./", type=str)
+    early_exit.add_argument("--model_name_or_path", required=True, type=str)
+    early_exit.add_argument("--do_lower_case", action="store_true")
+    early_exit.add_argument(
+        "--thresholds",
+        default=[0.0, 0.8, 0.9, 0.95, 0.99],
+        type=float,
+        nargs="+",
+    )
+    early_exit.add_argument(
+        "--folder_list", default=None, type=str, nargs="*",
+    )
+    early_exit.add_argument("--split", default="dev", type=str)
+    early_exit.add_argument("--max_seq_length", default=128, type=int)
+    early_exit.add_argument("--batch_size", default=32, type=int)
+    early_exit.add_argument("--num_threads", default=0, type=int)
+    early_exit.add_argument("--repeat", default=1, type=int)
+    early_exit.add_argument("--output_file", default="", type=str)
+    early_exit.set_defaults(func=benchmark_early_exit)
+
+    finetune = subparsers.add_parser(
+        "finetune",
+        help="Peak training memory and dev F1 of trained output directories.",
+    )
+    finetune.add_argument("--output_dirs", required=True, type=str, nargs="+")
+    finetune.add_argument("--output_file", default="", type=str)
+    finetune.set_defaults(func=benchmark_finetune)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
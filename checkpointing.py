@@ -0,0 +1,148 @@
+"""Background writing and retention of training checkpoints.
+
+`CheckpointWriter.save` snapshots the model, optimizer and scheduler states
+to CPU memory and returns; a background thread writes the snapshot into a
+temporary directory, renames it to ``checkpoint-N`` and prunes the
+checkpoints the retention policy no longer keeps. A ``checkpoint-N``
+directory is therefore always complete.
+"""
+
+import copy
+import glob
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PREFIX = "checkpoint-"
+
+
+def to_cpu(obj):
+    """Deep copy of `obj` with every tensor copied to CPU memory, so
+    training can go on updating the originals in place."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        copied = type(obj)((key, to_cpu(value)) for key, value in obj.items())
+        if hasattr(obj, "_metadata"):  # state dicts of nn.Module
+            copied._metadata = copy.deepcopy(obj._metadata)
+        return copied
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def checkpoint_step(path):
+    match = re.search(r"{}(\d+)$".format(CHECKPOINT_PREFIX), path)
+    return int(match.group(1)) if match else -1
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints to `output_dir` from a background thread.
+
+    Keeps the `save_total_limit` most recent checkpoints (all with 0) and,
+    when checkpoints are saved with a `metric`, the one with the highest
+    metric on top of them. At most one snapshot waits for the thread, so
+    `save` only blocks when checkpoints are saved faster than written.
+    """
+
+    def __init__(self, output_dir, save_total_limit=0, metric_file=None):
+        self.output_dir = output_dir
+        self.save_total_limit = save_total_limit
+        # file in each checkpoint holding its metric, for checkpoints
+        # written before a resume
+        self.metric_file = metric_file
+        self.metrics = {}
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        os.makedirs(output_dir, exist_ok=True)
+        for tmp_dir in glob.glob(os.path.join(output_dir, ".tmp-*")):
+            shutil.rmtree(tmp_dir)  # left over by an interrupted run
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def save(self, step, model, tokenizer, states, metric=None):
+        """Snapshots `model` and `states`, a dict of file name to object
+        (saved with `torch.save`), and queues them as ``checkpoint-step``."""
+        self._raise_error()
+        snapshot = (
+            step,
+            model,
+            to_cpu(model.state_dict()),
+            tokenizer,
+            {name: to_cpu(state) for name, state in states.items()},
+            metric,
+        )
+        self.queue.put(snapshot)
+
+    def close(self):
+        """Waits until every queued checkpoint is written."""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _work(self):
+        while True:
+            snapshot = self.queue.get()
+            if snapshot is None:
+                return
+            try:
+                self._write(*snapshot)
+                self._prune()
+            except Exception as ex:  # re-raised by the next save or close
+                self.error = ex
+
+    def _write(self, step, model, state_dict, tokenizer, states, metric):
+        name = CHECKPOINT_PREFIX + str(step)
+        tmp_dir = os.path.join(self.output_dir, ".tmp-" + name)
+        output_dir = os.path.join(self.output_dir, name)
+        os.makedirs(tmp_dir)
+        model.save_pretrained(tmp_dir, state_dict=state_dict)
+        tokenizer.save_pretrained(tmp_dir)
+        for file_name, state in states.items():
+            torch.save(state, os.path.join(tmp_dir, file_name))
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.replace(tmp_dir, output_dir)
+        if metric is not None:
+            self.metrics[output_dir] = metric
+        logger.info("Saved checkpoint to %s", output_dir)
+
+    def _metric(self, checkpoint):
+        if checkpoint not in self.metrics and self.metric_file:
+            path = os.path.join(checkpoint, self.metric_file)
+            state = (
+                torch.load(path, weights_only=False)
+                if os.path.isfile(path)
+                else {}
+            )
+            self.metrics[checkpoint] = state.get("metric")
+        return self.metrics.get(checkpoint)
+
+    def _prune(self):
+        if self.save_total_limit <= 0:
+            return
+        checkpoints = sorted(
+            glob.glob(os.path.join(self.output_dir, CHECKPOINT_PREFIX + "*")),
+            key=checkpoint_step,
+        )
+        keep = set(checkpoints[-self.save_total_limit :])
+        scored = [c for c in checkpoints if self._metric(c) is not None]
+        if scored:
+            keep.add(max(scored, key=self._metric))
+        for checkpoint in checkpoints:
+            if checkpoint not in keep:
+                logger.info("Deleting checkpoint %s", checkpoint)
+                shutil.rmtree(checkpoint)
+                self.metrics.pop(checkpoint, None)
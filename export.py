@@ -0,0 +1,329 @@
+"""Export a trained MultiHeadClassification model to ONNX or TorchScript.
+
+The encoder and both heads are traced into one static graph taking
+``input_ids``, ``attention_mask`` and ``token_type_ids`` (dynamic batch and
+sequence axes) and returning ``logits_a`` and ``logits_b``:
+
+    python export.py onnx --model_name_or_path trained-model
+    python export.py torchscript --model_name_or_path trained-model
+    python export.py check --model_name_or_path trained-model \
+        --data_dir ./ --do_lower_case
+
+`check` compares the exported graphs with the eager model on the dev CSVs.
+predict.py runs the exports with ``--backend onnx`` or ``--backend
+torchscript``.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+from torch import nn
+
+from run_classification import MultiHeadClassification
+from trac_dataloader import (
+    DynamicPaddingCollator,
+    TracProcessor,
+    convert_examples_to_features,
+)
+
+logger = logging.getLogger(__name__)
+
+ONNX_NAME = os.path.join("onnx", "model.onnx")
+TORCHSCRIPT_NAME = os.path.join("torchscript", "model.pt")
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+OUTPUT_NAMES = ["logits_a", "logits_b"]
+
+
+class ExportWrapper(nn.Module):
+    """Returns only ``(logits_a, logits_b)`` of a MultiHeadClassification,
+    the tuple of `forward` also holds the loss."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+        )
+        return outputs[1], outputs[2]
+
+
+class _ExportedModel(object):
+    """Calls like a MultiHeadClassification: keyword inputs, outputs
+    ``(loss, logits_a, logits_b)`` with a None loss."""
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+class OnnxMultiHeadClassifier(_ExportedModel):
+    """Runs an exported ONNX graph on ONNX Runtime with all graph
+    optimizations enabled."""
+
+    def __init__(self, path, num_threads=0):
+        import onnxruntime
+
+        self.path = path
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, input_ids, attention_mask, token_type_ids, **kwargs):
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": token_type_ids,
+        }
+        logits_a, logits_b = self.session.run(
+            OUTPUT_NAMES,
+            {
+                name: tensor.cpu().numpy().astype(np.int64)
+                for name, tensor in inputs.items()
+            },
+        )
+        return None, torch.from_numpy(logits_a), torch.from_numpy(logits_b)
+
+
+class TorchScriptMultiHeadClassifier(_ExportedModel):
+    """Runs an exported TorchScript module."""
+
+    def __init__(self, path, device="cpu"):
+        self.path = path
+        self.module = torch.jit.load(path, map_location=device)
+        self.module.eval()
+
+    def __call__(self, input_ids, attention_mask, token_type_ids, **kwargs):
+        logits_a, logits_b = self.module(
+            input_ids, attention_mask, token_type_ids
+        )
+        return None, logits_a, logits_b
+
+
+def load_backend(backend, model_name_or_path, device="cpu"):
+    """Model for `backend` ("pytorch", "onnx" or "torchscript")."""
+    if backend == "onnx":
+        return OnnxMultiHeadClassifier(
+            os.path.join(model_name_or_path, ONNX_NAME)
+        )
+    if backend == "torchscript":
+        return TorchScriptMultiHeadClassifier(
+            os.path.join(model_name_or_path, TORCHSCRIPT_NAME), device
+        )
+    return MultiHeadClassification.from_pretrained(model_name_or_path)
+
+
+def _example_inputs(batch_size=2, sequence_length=16):
+    input_ids = torch.randint(1000, (batch_size, sequence_length))
+    attention_mask = torch.ones_like(input_ids)
+    token_type_ids = torch.zeros_like(input_ids)
+    return input_ids, attention_mask, token_type_ids
+
+
+def _load_wrapper(model_name_or_path, torchscript=False):
+    model = MultiHeadClassification.from_pretrained(
+        model_name_or_path, torchscript=torchscript
+    )
+    model.eval()
+    return ExportWrapper(model)
+
+
+def export_onnx(args):
+    path = args.output_file or os.path.join(
+        args.model_name_or_path, ONNX_NAME
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    axes = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            _load_wrapper(args.model_name_or_path),
+            _example_inputs(),
+            path,
+            input_names=INPUT_NAMES,
+            output_names=OUTPUT_NAMES,
+            dynamic_axes={
+                **{name: axes for name in INPUT_NAMES},
+                **{name: {0: "batch"} for name in OUTPUT_NAMES},
+            },
+            opset_version=args.opset,
+            do_constant_folding=True,
+            # the dynamo exporter ignores dynamic_axes, builds at its own
+            # opset and writes the weights to a separate model.onnx.data
+            dynamo=False,
+        )
+    opset = onnx_opset(path)
+    if opset != args.opset:
+        raise RuntimeError(
+            "Exported %s at opset %d instead of %d" % (path, opset, args.opset)
+        )
+    logger.info("Saved ONNX model to %s (opset %d)", path, opset)
+
+
+def onnx_opset(path):
+    """Version of the default ONNX operator set imported by the graph."""
+    import onnx
+
+    model = onnx.load(path, load_external_data=False)
+    return next(
+        entry.version
+        for entry in model.opset_import
+        if entry.domain in ("", "ai.onnx")
+    )
+
+
+def export_torchscript(args):
+    path = args.output_file or os.path.join(
+        args.model_name_or_path, TORCHSCRIPT_NAME
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with torch.no_grad():
+        traced = torch.jit.trace(
+            _load_wrapper(args.model_name_or_path, torchscript=True),
+            _example_inputs(),
+        )
+    traced.save(path)
+    logger.info("Saved TorchScript model to %s", path)
+
+
+def check_parity(args):
+    """Compares the logits of the exported graphs with the eager model on
+    the dev set of every language. Exits with 1 above --atol."""
+    from transformers import BertTokenizer
+
+    tokenizer = BertTokenizer.from_pretrained(
+        args.model_name_or_path, do_lower_case=args.do_lower_case
+    )
+    eager = load_backend("pytorch", args.model_name_or_path)
+    eager.eval()
+    backends = {
+        backend: load_backend(backend, args.model_name_or_path)
+        for backend in args.backends
+    }
+    processor = TracProcessor(args.folder_list)
+    collator = DynamicPaddingCollator(pad_token_id=tokenizer.pad_token_id)
+    report, failed = [], False
+    for language in processor.folder_list:
+        examples = processor.get_examples(args.data_dir, args.split, [language])
+        features = convert_examples_to_features(
+            examples,
+            tokenizer,
+            label_list=processor.get_labels(),
+            max_seq_length=args.max_seq_length,
+            output_mode="classification",
+            pad_token=tokenizer.pad_token_id,
+            pad_to_max_length=False,
+        )
+        diffs = {backend: 0.0 for backend in backends}
+        agree = {backend: 0 for backend in backends}
+        for start in range(0, len(features), args.batch_size):
+            batch = collator(
+                [
+                    (
+                        torch.tensor(f.input_ids),
+                        torch.tensor(f.input_mask),
+                        torch.tensor(f.segment_ids),
+                    )
+                    for f in features[start : start + args.batch_size]
+                ]
+            )
+            inputs = dict(zip(INPUT_NAMES, batch))
+            with torch.no_grad():
+                expected = eager(**inputs)[1:3]
+                for backend, model in backends.items():
+                    outputs = model(**inputs)[1:3]
+                    for want, got in zip(expected, outputs):
+                        diffs[backend] = max(
+                            diffs[backend], (want - got).abs().max().item()
+                        )
+                    agree[backend] += int(
+                        (
+                            (expected[0].argmax(-1) == outputs[0].argmax(-1))
+                            & (expected[1].argmax(-1) == outputs[1].argmax(-1))
+                        ).sum()
+                    )
+        for backend in backends:
+            result = {
+                "language": language,
+                "backend": backend,
+                "examples": len(features),
+                "max_abs_diff": diffs[backend],
+                "label_agreement": agree[backend] / max(1, len(features)),
+            }
+            failed |= diffs[backend] > args.atol
+            print(json.dumps(result))
+            report.append(result)
+    if failed:
+        sys.exit(1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, func in (
+        ("onnx", export_onnx),
+        ("torchscript", export_torchscript),
+        ("check", check_parity),
+    ):
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument(
+            "--model_name_or_path",
+            default=None,
+            type=str,
+            required=True,
+            help="Directory of a model trained with run_classification.py",
+        )
+        subparser.set_defaults(func=func)
+        if name == "check":
+            subparser.add_argument("--data_dir", default="./", type=str)
+            subparser.add_argument(
+                "--folder_list", default=None, type=str, nargs="*"
+            )
+            subparser.add_argument("--split", default="dev", type=str)
+            subparser.add_argument("--do_lower_case", action="store_true")
+            subparser.add_argument(
+                "--backends",
+                default=["onnx", "torchscript"],
+                choices=["onnx", "torchscript"],
+                nargs="+",
+            )
+            subparser.add_argument("--max_seq_length", default=128, type=int)
+            subparser.add_argument("--batch_size", default=32, type=int)
+            subparser.add_argument("--atol", default=1e-4, type=float)
+        else:
+            subparser.add_argument(
+                "--output_file",
+                default="",
+                type=str,
+                help="Defaults to a file in MODEL_NAME_OR_PATH/" + name,
+            )
+        if name == "onnx":
+            subparser.add_argument("--opset", default=14, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Step-level instrumentation of the training loop.
+
+`StepMonitor` splits the wall time of the loop into phases and tracks
+throughput, padding and peak GPU memory between two reports, next to the
+peak RSS of the process since it started. `TraceWindow`
+records a `torch.profiler` trace over a range of optimization steps.
+"""
+
+import json
+import os
+import resource
+import time
+
+import torch
+
+PHASES = ("data", "forward", "backward", "clip", "optimizer", "eval", "save")
+
+
+class StepMonitor(object):
+    """Accumulates per-phase wall time, examples, tokens and padding.
+
+    The loop calls `lap(phase)` at the end of each phase; the time since the
+    previous lap is charged to `phase`. CUDA kernels run asynchronously, so
+    by default a phase is only charged for launching them and the device is
+    synchronized once per report. With `synchronize_phases` it is
+    synchronized at every lap, which charges kernels to the phase launching
+    them but stalls the loop several times per step.
+    """
+
+    def __init__(self, device, metrics_file=None, synchronize_phases=False):
+        self.device = torch.device(device)
+        self.metrics_file = metrics_file
+        self.synchronize_phases = synchronize_phases
+        if metrics_file:
+            os.makedirs(os.path.dirname(metrics_file) or ".", exist_ok=True)
+        self._reset()
+
+    def _reset(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.examples = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.last = time.perf_counter()
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def lap(self, phase):
+        if self.synchronize_phases:
+            self._synchronize()
+        now = time.perf_counter()
+        self.times[phase] += now - self.last
+        self.last = now
+
+    def count_batch(self, attention_mask):
+        self.examples += attention_mask.size(0)
+        # summed on the mask's device, read back once per report
+        self.tokens = self.tokens + attention_mask.sum()
+        self.padded_tokens += attention_mask.numel()
+
+    def report(self, step):
+        """Metrics since the previous report, which are then reset."""
+        self._synchronize()
+        self.lap("data")
+        elapsed = sum(self.times.values())
+        tokens = int(self.tokens)
+        metrics = {
+            "time_{}_s".format(phase): seconds
+            for phase, seconds in self.times.items()
+        }
+        metrics.update(
+            {
+                "data_wait_fraction": self.times["data"] / elapsed,
+                "examples_per_s": self.examples / elapsed,
+                "tokens_per_s": tokens / elapsed,
+                "padding_ratio": 1 - tokens / max(1, self.padded_tokens),
+                # ru_maxrss is the peak over the life of the process (not
+                # of this report), in KB on Linux
+                "max_rss_mb": resource.getrusage(
+                    resource.RUSAGE_SELF
+                ).ru_maxrss
+                / 1024,
+            }
+        )
+        if self.device.type == "cuda":
+            metrics["peak_gpu_memory_mb"] = (
+                torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+            )
+        if self.metrics_file:
+            with open(self.metrics_file, "a") as f:
+                f.write(json.dumps({"step": step, **metrics}) + "\n")
+        self._reset()
+        return metrics
+
+
+class TraceWindow(object):
+    """Runs `torch.profiler` from optimization step `start` until step
+    `end` and writes the trace to `trace_dir` (open it with TensorBoard)."""
+
+    def __init__(self, start, end, trace_dir, device):
+        self.start = start
+        self.end = end
+        self.trace_dir = trace_dir
+        self.device = torch.device(device)
+        self.profiler = None
+        self.done = False
+
+    def step(self, global_step):
+        """Called after every optimization step."""
+        if self.done:
+            return
+        if self.profiler is None and self.start <= global_step < self.end:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                record_shapes=True,
+                profile_memory=True,
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    self.trace_dir
+                ),
+            )
+            self.profiler.start()
+        elif self.profiler is not None and global_step >= self.end:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+            self.done = True
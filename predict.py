@@ -0,0 +1,279 @@
+"""Batch inference with a trained MultiHeadClassification model.
+
+Reads comments from a CSV or JSON lines file (or stdin) chunk by chunk and
+writes one ``ID,label_a,label_b,prob_a_*,prob_b_*`` row per comment as soon
+as its chunk is scored, so arbitrarily large inputs run in bounded memory:
+
+    python predict.py --model_name_or_path trained-model \
+        --input comments.csv --output predictions.csv
+"""
+
+import argparse
+import csv
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import torch
+
+from run_classification import (
+    FAST_TOKENIZER_CLASSES,
+    MODEL_CLASSES,
+    QUANTIZED_WEIGHTS_NAME,
+    MultiHeadClassification,
+    load_quantized_model,
+    quantize_model,
+)
+from export import load_backend
+from trac_dataloader import (
+    DynamicPaddingCollator,
+    InputExample,
+    convert_examples_to_features,
+    processors,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def iter_input_chunks(args):
+    """Yields DataFrames of at most `args.chunksize` rows of the input."""
+    source = sys.stdin if args.input == "-" else args.input
+    if args.input_format == "jsonl":
+        reader = pd.read_json(source, lines=True, chunksize=args.chunksize)
+    else:
+        reader = pd.read_csv(source, chunksize=args.chunksize)
+    for chunk in reader:
+        yield chunk
+
+
+def load_model(args):
+    config_class, _, tokenizer_class = MODEL_CLASSES[args.model_type]
+    if (
+        not args.no_fast_tokenizer
+        and FAST_TOKENIZER_CLASSES.get(args.model_type) is not None
+    ):
+        tokenizer_class = FAST_TOKENIZER_CLASSES[args.model_type]
+    tokenizer_kwargs = {"do_lower_case": True} if args.do_lower_case else {}
+    tokenizer = tokenizer_class.from_pretrained(
+        args.tokenizer_name or args.model_name_or_path, **tokenizer_kwargs
+    )
+    if args.backend != "pytorch":
+        # exported graphs run on CPU
+        args.device = torch.device("cpu")
+        model = load_backend(args.backend, args.model_name_or_path)
+    elif args.quantize:
+        # dynamically quantized kernels only exist for CPU
+        args.device = torch.device("cpu")
+        quantized_dir = os.path.join(args.model_name_or_path, "quantized")
+        quantized_weights = os.path.join(quantized_dir, QUANTIZED_WEIGHTS_NAME)
+        if os.path.exists(quantized_weights):
+            model = load_quantized_model(quantized_dir)
+        else:
+            model = quantize_model(
+                MultiHeadClassification.from_pretrained(
+                    args.model_name_or_path
+                )
+            )
+    else:
+        model = MultiHeadClassification.from_pretrained(
+            args.model_name_or_path
+        )
+    if isinstance(model, MultiHeadClassification):
+        model.early_exit_threshold = args.early_exit_threshold
+    model.to(args.device)
+    model.eval()
+    return model, tokenizer
+
+
+def predict_chunk(args, model, tokenizer, collator, label_list, examples):
+    """Returns the softmax probabilities of both heads for `examples`."""
+    features = convert_examples_to_features(
+        examples,
+        tokenizer,
+        label_list=label_list,
+        max_seq_length=args.max_seq_length,
+        output_mode="classification",
+        pad_token=tokenizer.pad_token_id,
+        pad_to_max_length=False,
+    )
+    language_ids = None
+    if getattr(model, "head_languages", None):
+        # every example goes through the heads of its language
+        language_ids = model.language_ids([e.language for e in examples])
+    # batch similar lengths together, the rows are put back in order below
+    order = np.argsort([len(f.input_ids) for f in features], kind="stable")
+    probs_a = np.empty((len(features), len(label_list["a"])), np.float32)
+    probs_b = np.empty((len(features), len(label_list["b"])), np.float32)
+    for start in range(0, len(order), args.batch_size):
+        indices = order[start : start + args.batch_size]
+        batch = collator(
+            [
+                (
+                    torch.tensor(features[i].input_ids),
+                    torch.tensor(features[i].input_mask),
+                    torch.tensor(features[i].segment_ids),
+                )
+                for i in indices
+            ]
+        )
+        batch = tuple(t.to(args.device) for t in batch)
+        inputs = {
+            "input_ids": batch[0],
+            "attention_mask": batch[1],
+            "token_type_ids": batch[2],
+        }
+        if language_ids is not None:
+            inputs["language_ids"] = language_ids[indices].to(args.device)
+        with torch.no_grad():
+            outputs = model(**inputs)
+        logits_a, logits_b = outputs[1:3]
+        probs_a[indices] = torch.softmax(logits_a, dim=-1).cpu().numpy()
+        probs_b[indices] = torch.softmax(logits_b, dim=-1).cpu().numpy()
+    return probs_a, probs_b
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name_or_path",
+        default=None,
+        type=str,
+        required=True,
+        help="Directory of a model trained with run_classification.py",
+    )
+    parser.add_argument(
+        "--input",
+        default="-",
+        type=str,
+        help="CSV or JSON lines file to score, - for stdin",
+    )
+    parser.add_argument(
+        "--output",
+        default="-",
+        type=str,
+        help="Where to write the predictions CSV, - for stdout",
+    )
+    parser.add_argument(
+        "--input_format", default="csv", choices=["csv", "jsonl"]
+    )
+    parser.add_argument(
+        "--id_column",
+        default="ID",
+        type=str,
+        help="Column with the comment ids (row numbers if missing)",
+    )
+    parser.add_argument("--text_column", default="Text", type=str)
+    parser.add_argument(
+        "--language_column",
+        default="language",
+        type=str,
+        help="Column with the language of every comment, for a model trained "
+        "with --language_heads (--language if missing)",
+    )
+    parser.add_argument(
+        "--language",
+        default=None,
+        type=str,
+        help="Language of the comments without a language column",
+    )
+    parser.add_argument("--model_type", default="bert", type=str)
+    parser.add_argument("--task_name", default="trac", type=str)
+    parser.add_argument(
+        "--tokenizer_name",
+        default="",
+        type=str,
+        help="Pretrained tokenizer name or path if not the same as model_name",
+    )
+    parser.add_argument("--do_lower_case", action="store_true")
+    parser.add_argument("--no_fast_tokenizer", action="store_true")
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument(
+        "--chunksize",
+        default=10000,
+        type=int,
+        help="Rows read, tokenized and written at a time",
+    )
+    parser.add_argument("--batch_size", default=64, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Run an int8 dynamically quantized model on CPU",
+    )
+    parser.add_argument(
+        "--early_exit_threshold",
+        default=0.0,
+        type=float,
+        help="Stop at the first early exit where both heads reach this probability",
+    )
+    parser.add_argument(
+        "--backend",
+        default="pytorch",
+        choices=["pytorch", "onnx", "torchscript"],
+        help="Run the model saved by `export.py onnx` or `export.py torchscript`",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    args.device = torch.device(
+        "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu"
+    )
+    label_list = processors[args.task_name]().get_labels()
+    model, tokenizer = load_model(args)
+    collator = DynamicPaddingCollator(pad_token_id=tokenizer.pad_token_id)
+
+    output = (
+        sys.stdout
+        if args.output == "-"
+        else open(args.output, "w", newline="", encoding="utf-8")
+    )
+    writer = csv.writer(output)
+    writer.writerow(
+        ["ID", "label_a", "label_b"]
+        + ["prob_a_" + label for label in label_list["a"]]
+        + ["prob_b_" + label for label in label_list["b"]]
+    )
+    num_rows = 0
+    for chunk in iter_input_chunks(args):
+        if args.id_column in chunk:
+            ids = chunk[args.id_column].tolist()
+        else:
+            ids = list(range(num_rows, num_rows + len(chunk)))
+        if args.language_column in chunk:
+            languages = chunk[args.language_column].tolist()
+        else:
+            languages = [args.language] * len(chunk)
+        examples = [
+            InputExample(guid=guid, text=str(text), language=language)
+            for guid, text, language in zip(
+                ids, chunk[args.text_column].tolist(), languages
+            )
+        ]
+        probs_a, probs_b = predict_chunk(
+            args, model, tokenizer, collator, label_list, examples
+        )
+        labels_a = np.array(label_list["a"])[probs_a.argmax(axis=1)]
+        labels_b = np.array(label_list["b"])[probs_b.argmax(axis=1)]
+        writer.writerows(
+            [guid, label_a, label_b]
+            + ["%.6f" % p for p in prob_a]
+            + ["%.6f" % p for p in prob_b]
+            for guid, label_a, label_b, prob_a, prob_b in zip(
+                ids, labels_a, labels_b, probs_a, probs_b
+            )
+        )
+        output.flush()
+        num_rows += len(chunk)
+        logger.info("Scored %d comments", num_rows)
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
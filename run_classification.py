@@ -19,22 +19,26 @@
 
 
 import argparse
+import copy
+import csv
 import glob
 import json
 import logging
 import os
 import random
+import shutil
 import traceback
 
 import numpy as np
 import torch
+import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss
 from torch.utils.data import (
+    BatchSampler,
     DataLoader,
-    RandomSampler,
     SequentialSampler,
-    TensorDataset,
 )
 from torch.utils.data.distributed import DistributedSampler
 
@@ -51,11 +55,27 @@ from transformers import (
     get_linear_schedule_with_warmup,
 )
 
+from checkpointing import CheckpointWriter
+from instrumentation import StepMonitor, TraceWindow
 from trac_dataloader import (
+    DevicePrefetcher,
+    DynamicPaddingCollator,
+    FeatureDataset,
+    LengthGroupedSampler,
+    LogitsStore,
+    SkipBatchSampler,
+    TokenBudgetBatchSampler,
     compute_metrics,
-    convert_examples_to_features,
+    convert_examples_to_features_parallel,
+    evict_feature_cache,
+    feature_cache_key,
+    feature_options_key,
+    features_to_columns,
+    file_digest,
+    invalidate_feature_unit,
     output_modes,
     processors,
+    tokenizer_fingerprint,
 )
 
 try:
@@ -63,10 +83,57 @@ try:
 except ImportError:
     from tensorboardX import SummaryWriter
 
+try:
+    from transformers import BertTokenizerFast
+except ImportError:
+    BertTokenizerFast = None
+
 
 logger = logging.getLogger(__name__)
 
 MODEL_CLASSES = {"bert": (BertConfig, BertPreTrainedModel, BertTokenizer)}
+# Rust-backed tokenizers used for featurization when installed
+FAST_TOKENIZER_CLASSES = {"bert": BertTokenizerFast}
+
+
+class LoRALinear(nn.Linear):
+    """nn.Linear plus a trainable low-rank update ``B @ A`` scaled by
+    ``alpha / rank``. B starts at zero, so the layer starts out as the
+    pretrained one. The weight and bias keep their names, so pretrained
+    checkpoints load into it unchanged."""
+
+    def __init__(self, in_features, out_features, rank, alpha, dropout=0.0):
+        super().__init__(in_features, out_features)
+        self.lora_A = nn.Parameter(torch.empty(rank, in_features))
+        self.lora_B = nn.Parameter(torch.empty(out_features, rank))
+        self.lora_dropout = nn.Dropout(dropout)
+        self.scaling = alpha / rank
+        self.reset_lora_parameters()
+
+    def reset_lora_parameters(self):
+        nn.init.kaiming_uniform_(self.lora_A, a=5 ** 0.5)
+        nn.init.zeros_(self.lora_B)
+
+    def forward(self, input):
+        update = F.linear(
+            F.linear(self.lora_dropout(input), self.lora_A), self.lora_B
+        )
+        return super().forward(input) + update * self.scaling
+
+
+# parameters trained and saved in low-rank adaptation mode, besides lora_*
+ADAPTER_MODULES = (
+    "bert.pooler.",
+    "classifier_a.",
+    "classifier_b.",
+    "exit_classifiers_a.",
+    "exit_classifiers_b.",
+)
+ADAPTER_WEIGHTS_NAME = "adapter_model.bin"
+
+
+def is_adapter_parameter(name):
+    return ".lora_" in name or name.startswith(ADAPTER_MODULES)
 
 
 class MultiHeadClassification(BertPreTrainedModel):
@@ -128,15 +195,154 @@ class MultiHeadClassification(BertPreTrainedModel):
 
         self.bert = BertModel(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
-        self.classifier_a = nn.Linear(
-            config.hidden_size, self.config.num_labels_a
+        # with config.head_languages, the shared encoder feeds one
+        # classifier_a/classifier_b pair per language, picked per example
+        self.head_languages = list(
+            getattr(config, "head_languages", None) or []
+        )
+        if self.head_languages:
+            self.classifier_a = nn.ModuleList(
+                nn.Linear(config.hidden_size, self.num_labels_a)
+                for _ in self.head_languages
+            )
+            self.classifier_b = nn.ModuleList(
+                nn.Linear(config.hidden_size, self.num_labels_b)
+                for _ in self.head_languages
+            )
+        else:
+            self.classifier_a = nn.Linear(
+                config.hidden_size, self.config.num_labels_a
+            )
+            self.classifier_b = nn.Linear(
+                config.hidden_size, self.config.num_labels_b
+            )
+        # intermediate heads on the (1-based) layers in
+        # config.early_exit_layers, sharing the pooler of self.bert
+        self.early_exit_layers = list(
+            getattr(config, "early_exit_layers", None) or []
         )
-        self.classifier_b = nn.Linear(
-            config.hidden_size, self.config.num_labels_b
+        if self.early_exit_layers and self.head_languages:
+            raise ValueError("early exits need a single pair of heads")
+        self.exit_classifiers_a = nn.ModuleList(
+            nn.Linear(config.hidden_size, self.num_labels_a)
+            for _ in self.early_exit_layers
         )
+        self.exit_classifiers_b = nn.ModuleList(
+            nn.Linear(config.hidden_size, self.num_labels_b)
+            for _ in self.early_exit_layers
+        )
+        # at inference, an example leaves at the first exit where both heads
+        # are at least this confident (0 runs every layer)
+        self.early_exit_threshold = 0.0
+        # low-rank adaptation: config.lora_target_modules of every encoder
+        # layer get a LoRALinear update, the rest of the encoder is frozen
+        self.lora_rank = getattr(config, "lora_rank", 0)
+        if self.lora_rank > 0:
+            self._add_lora(config)
 
         self.init_weights()
 
+    def _add_lora(self, config):
+        targets = [
+            (parent, name, child)
+            for parent in self.bert.encoder.modules()
+            for name, child in parent.named_children()
+            if name in config.lora_target_modules and type(child) is nn.Linear
+        ]
+        for parent, name, child in targets:
+            setattr(
+                parent,
+                name,
+                LoRALinear(
+                    child.in_features,
+                    child.out_features,
+                    config.lora_rank,
+                    config.lora_alpha,
+                    config.lora_dropout,
+                ),
+            )
+        for name, param in self.named_parameters():
+            param.requires_grad = is_adapter_parameter(name)
+
+    def _init_weights(self, module):
+        super()._init_weights(module)
+        if isinstance(module, LoRALinear):
+            module.reset_lora_parameters()
+
+    def save_pretrained(self, save_directory, state_dict=None, **kwargs):
+        """In low-rank adaptation mode only the adapter weights (see
+        `is_adapter_parameter`) are saved; `from_pretrained` loads them on
+        top of config.lora_base_model."""
+        if self.lora_rank <= 0:
+            return super().save_pretrained(
+                save_directory, state_dict=state_dict, **kwargs
+            )
+        os.makedirs(save_directory, exist_ok=True)
+        self.config.save_pretrained(save_directory)
+        if state_dict is None:
+            state_dict = self.state_dict()
+        torch.save(
+            {
+                name: value
+                for name, value in state_dict.items()
+                if is_adapter_parameter(name)
+            },
+            os.path.join(save_directory, ADAPTER_WEIGHTS_NAME),
+        )
+
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, *args, **kwargs):
+        adapter_file = os.path.join(
+            str(pretrained_model_name_or_path), ADAPTER_WEIGHTS_NAME
+        )
+        if not os.path.isfile(adapter_file):
+            return super().from_pretrained(
+                pretrained_model_name_or_path, *args, **kwargs
+            )
+        config = kwargs.pop("config", None) or BertConfig.from_pretrained(
+            pretrained_model_name_or_path
+        )
+        kwargs.pop("from_tf", None)
+        # the base model has no adapter weights, keep transformers from
+        # reporting them as newly initialized; they are checked below
+        modeling_logger = logging.getLogger("transformers.modeling_utils")
+        level = modeling_logger.level
+        modeling_logger.setLevel(logging.ERROR)
+        try:
+            model, loading_info = super().from_pretrained(
+                config.lora_base_model,
+                *args,
+                config=config,
+                output_loading_info=True,
+                **kwargs,
+            )
+        finally:
+            modeling_logger.setLevel(level)
+        result = model.load_state_dict(
+            torch.load(adapter_file, map_location="cpu"), strict=False
+        )
+        missing = [
+            name for name in result.missing_keys if is_adapter_parameter(name)
+        ]
+        if missing or result.unexpected_keys:
+            raise ValueError(
+                "%s does not match the model: missing %s, unexpected %s"
+                % (adapter_file, missing, result.unexpected_keys)
+            )
+        initialized = [
+            name
+            for name in loading_info["missing_keys"]
+            if not is_adapter_parameter(name)
+        ]
+        if initialized:
+            logger.warning(
+                "Weights of %s not in the base model %s and newly initialized: %s",
+                pretrained_model_name_or_path,
+                config.lora_base_model,
+                initialized,
+            )
+        return model
+
     def forward(
         self,
         input_ids=None,
@@ -147,10 +353,31 @@ class MultiHeadClassification(BertPreTrainedModel):
         inputs_embeds=None,
         labels_a=None,
         labels_b=None,
+        language_ids=None,
         *args,
         **kwargs,
     ):
 
+        if self.early_exit_layers and inputs_embeds is None:
+            if not self.training and self.early_exit_threshold > 0:
+                return self._forward_early_exit(
+                    input_ids,
+                    attention_mask,
+                    token_type_ids,
+                    position_ids,
+                    labels_a,
+                    labels_b,
+                )
+            return self._forward_with_exits(
+                input_ids,
+                attention_mask,
+                token_type_ids,
+                position_ids,
+                head_mask,
+                labels_a,
+                labels_b,
+            )
+
         outputs = self.bert(
             input_ids,
             attention_mask=attention_mask,
@@ -163,13 +390,23 @@ class MultiHeadClassification(BertPreTrainedModel):
         pooled_output = outputs[1]
 
         pooled_output = self.dropout(pooled_output)
-        logits_a = self.classifier_a(pooled_output)
-        logits_b = self.classifier_b(pooled_output)
+        if self.head_languages:
+            logits_a, logits_b = self._language_heads(
+                pooled_output, language_ids
+            )
+        else:
+            logits_a = self.classifier_a(pooled_output)
+            logits_b = self.classifier_b(pooled_output)
 
         outputs = (
             (logits_a,) + (logits_b,) + outputs[2:]
         )  # add hidden states and attention if they are here
 
+        loss = self._loss(logits_a, logits_b, labels_a, labels_b)
+        outputs = (loss,) + outputs
+        return outputs  # (loss), logits, (hidden_states), (attentions)
+
+    def _loss(self, logits_a, logits_b, labels_a, labels_b):
         loss = 0
         for labels, logits, num_labels in (
             (labels_a, logits_a, self.num_labels_a),
@@ -185,8 +422,256 @@ class MultiHeadClassification(BertPreTrainedModel):
                     loss += loss_fct(
                         logits.view(-1, num_labels), labels.view(-1)
                     )
-        outputs = (loss,) + outputs
-        return outputs  # (loss), logits, (hidden_states), (attentions)
+        return loss
+
+    def language_ids(self, languages):
+        """Index in config.head_languages of every language in `languages`,
+        the `language_ids` input of a model with per-language heads."""
+        unknown = set(languages) - set(self.head_languages)
+        if unknown:
+            raise ValueError(
+                "No heads for languages {} (the model has heads for {})".format(
+                    sorted(unknown, key=str), self.head_languages
+                )
+            )
+        return torch.tensor(
+            [self.head_languages.index(language) for language in languages],
+            dtype=torch.long,
+        )
+
+    def _language_heads(self, pooled_output, language_ids):
+        """Logits of the heads of each example's language. Every pair of
+        heads scores the whole batch (they are tiny next to the encoder),
+        so mixed-language batches take one forward pass."""
+        if language_ids is None:
+            raise ValueError(
+                "A model with per-language heads needs language_ids"
+            )
+        rows = torch.arange(len(language_ids), device=language_ids.device)
+        return tuple(
+            torch.stack([clf(pooled_output) for clf in classifiers], dim=1)[
+                rows, language_ids
+            ]
+            for classifiers in (self.classifier_a, self.classifier_b)
+        )
+
+    def _embed(self, input_ids, attention_mask, token_type_ids, position_ids):
+        """Runs the embeddings of self.bert, returns the hidden states and
+        the additive attention mask its encoder layers take."""
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        hidden_states = self.bert.embeddings(
+            input_ids=input_ids,
+            position_ids=position_ids,
+            token_type_ids=token_type_ids,
+        )
+        dtype = hidden_states.dtype
+        extended_attention_mask = (
+            1.0 - attention_mask[:, None, None, :].to(dtype)
+        ) * torch.finfo(dtype).min
+        return hidden_states, extended_attention_mask
+
+    def _classify(self, hidden_states, classifier_a, classifier_b):
+        pooled_output = self.dropout(self.bert.pooler(hidden_states))
+        return classifier_a(pooled_output), classifier_b(pooled_output)
+
+    def _forward_with_exits(
+        self,
+        input_ids,
+        attention_mask,
+        token_type_ids,
+        position_ids,
+        head_mask,
+        labels_a,
+        labels_b,
+    ):
+        """Runs every layer; the loss is summed over the final heads and
+        the heads of every exit, so they are trained jointly."""
+        hidden_states, extended_attention_mask = self._embed(
+            input_ids, attention_mask, token_type_ids, position_ids
+        )
+        loss = 0
+        for i, layer in enumerate(self.bert.encoder.layer):
+            layer_head_mask = head_mask[i] if head_mask is not None else None
+            if self.bert.encoder.gradient_checkpointing and self.training:
+                # recompute the activations of the layer in the backward
+                hidden_states = torch.utils.checkpoint.checkpoint(
+                    layer,
+                    hidden_states,
+                    extended_attention_mask,
+                    layer_head_mask,
+                    use_reentrant=False,
+                )[0]
+            else:
+                hidden_states = layer(
+                    hidden_states,
+                    attention_mask=extended_attention_mask,
+                    head_mask=layer_head_mask,
+                )[0]
+            if i + 1 in self.early_exit_layers:
+                index = self.early_exit_layers.index(i + 1)
+                loss += self._loss(
+                    *self._classify(
+                        hidden_states,
+                        self.exit_classifiers_a[index],
+                        self.exit_classifiers_b[index],
+                    ),
+                    labels_a,
+                    labels_b,
+                )
+        logits_a, logits_b = self._classify(
+            hidden_states, self.classifier_a, self.classifier_b
+        )
+        loss += self._loss(logits_a, logits_b, labels_a, labels_b)
+        return loss, logits_a, logits_b
+
+    def _forward_early_exit(
+        self,
+        input_ids,
+        attention_mask,
+        token_type_ids,
+        position_ids,
+        labels_a,
+        labels_b,
+    ):
+        """Drops the examples whose exit heads are both confident from the
+        batch, so later layers only run on the remaining ones. The outputs
+        also hold the number of layers each example went through."""
+        hidden_states, extended_attention_mask = self._embed(
+            input_ids, attention_mask, token_type_ids, position_ids
+        )
+        num_layers = len(self.bert.encoder.layer)
+        batch_size = hidden_states.size(0)
+        logits_a = hidden_states.new_empty(batch_size, self.num_labels_a)
+        logits_b = hidden_states.new_empty(batch_size, self.num_labels_b)
+        exit_layers = torch.full(
+            (batch_size,), num_layers, dtype=torch.long, device=input_ids.device
+        )
+        active = torch.arange(batch_size, device=input_ids.device)
+        for i, layer in enumerate(self.bert.encoder.layer):
+            hidden_states = layer(
+                hidden_states, attention_mask=extended_attention_mask
+            )[0]
+            if i + 1 not in self.early_exit_layers or i + 1 == num_layers:
+                continue
+            index = self.early_exit_layers.index(i + 1)
+            exit_a, exit_b = self._classify(
+                hidden_states,
+                self.exit_classifiers_a[index],
+                self.exit_classifiers_b[index],
+            )
+            done = (
+                exit_a.softmax(-1).max(-1)[0] >= self.early_exit_threshold
+            ) & (exit_b.softmax(-1).max(-1)[0] >= self.early_exit_threshold)
+            if not done.any():
+                continue
+            logits_a[active[done]] = exit_a[done]
+            logits_b[active[done]] = exit_b[done]
+            exit_layers[active[done]] = i + 1
+            keep = ~done
+            active = active[keep]
+            hidden_states = hidden_states[keep]
+            extended_attention_mask = extended_attention_mask[keep]
+            if not len(active):
+                break
+        if len(active):
+            logits_a[active], logits_b[active] = self._classify(
+                hidden_states, self.classifier_a, self.classifier_b
+            )
+        loss = self._loss(logits_a, logits_b, labels_a, labels_b)
+        return loss, logits_a, logits_b, exit_layers
+
+
+QUANTIZED_WEIGHTS_NAME = "pytorch_model_int8.bin"
+
+
+def quantize_model(model):
+    """int8 dynamic quantization of every nn.Linear (the encoder layers of
+    `model.bert`, `classifier_a` and `classifier_b`) for CPU inference."""
+    model.to("cpu")
+    model.eval()
+    return torch.quantization.quantize_dynamic(
+        model, {nn.Linear}, dtype=torch.qint8
+    )
+
+
+def save_quantized_model(model, output_dir):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    model.config.save_pretrained(output_dir)
+    torch.save(
+        model.state_dict(), os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME)
+    )
+
+
+def load_quantized_model(model_dir):
+    """Loads a model saved by `save_quantized_model`."""
+    config = BertConfig.from_pretrained(model_dir)
+    model = quantize_model(MultiHeadClassification(config))
+    model.load_state_dict(
+        torch.load(os.path.join(model_dir, QUANTIZED_WEIGHTS_NAME))
+    )
+    return model
+
+
+def init_student(model, num_hidden_layers):
+    """A copy of `model` keeping `num_hidden_layers` evenly spaced encoder
+    layers (always the first and the last one), the embeddings, pooler and
+    both classifiers. Early exit heads are not kept."""
+    config = copy.deepcopy(model.config)
+    config.early_exit_layers = []
+    layers = [
+        int(layer)
+        for layer in np.linspace(
+            0, config.num_hidden_layers - 1, num_hidden_layers
+        ).round()
+    ]
+    config.num_hidden_layers = num_hidden_layers
+    student = MultiHeadClassification(config)
+    state_dict = {}
+    for name, value in model.state_dict().items():
+        if name.startswith("exit_classifiers_"):
+            continue
+        prefix = "bert.encoder.layer."
+        if name.startswith(prefix):
+            layer, rest = name[len(prefix) :].split(".", 1)
+            if int(layer) not in layers:
+                continue
+            name = prefix + "{}.{}".format(layers.index(int(layer)), rest)
+        state_dict[name] = value
+    student.load_state_dict(state_dict)
+    logger.info("Initialized the student from layers %s", layers)
+    return student
+
+
+def distillation_loss(loss, logits, teacher_logits, alpha, temperature):
+    """`alpha` times the KL divergence between the temperature-softened
+    teacher and student distributions, summed over both heads, plus
+    `1 - alpha` times the hard label `loss`."""
+    soft_loss = 0
+    for student, teacher in zip(logits, teacher_logits):
+        # autocast may have produced half precision logits
+        student, teacher = student.float(), teacher.float()
+        if student.size(-1) == 1:
+            soft_loss += F.mse_loss(student, teacher)
+        else:
+            soft_loss += F.kl_div(
+                F.log_softmax(student / temperature, dim=-1),
+                F.softmax(teacher / temperature, dim=-1),
+                reduction="batchmean",
+            ) * (temperature ** 2)
+    return alpha * soft_loss + (1 - alpha) * loss.mean()
+
+
+def autocast(args):
+    """Mixed precision context of the forward passes: fp16 with --fp16,
+    bf16 with --bf16, full precision otherwise."""
+    dtype = torch.float16 if args.fp16 else torch.bfloat16
+    return torch.autocast(
+        device_type=args.device.type,
+        dtype=dtype,
+        enabled=args.fp16 or args.bf16,
+    )
 
 
 def set_seed(args):
@@ -197,19 +682,125 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
-def train(args, train_dataset, model, tokenizer):
-    """Train the model."""
+def get_rng_state():
+    """States of the Python, NumPy and torch (CPU and CUDA) RNGs."""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def get_collator(args, tokenizer):
+    return DynamicPaddingCollator(
+        pad_token_id=tokenizer.pad_token_id,
+        pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+    )
+
+
+def dataloader_kwargs(args, persistent=True):
+    """Worker, pinned memory and prefetching options of the DataLoaders.
+    Workers only persist across epochs for loaders iterated several times."""
+    kwargs = {
+        "num_workers": args.dataloader_num_workers,
+        "pin_memory": args.dataloader_pin_memory and args.device.type == "cuda",
+    }
+    if args.dataloader_num_workers > 0:
+        kwargs["prefetch_factor"] = args.dataloader_prefetch_factor
+        kwargs["persistent_workers"] = (
+            persistent and args.dataloader_persistent_workers
+        )
+    return kwargs
+
+
+def device_batches(args, dataloader):
+    """`dataloader` batches on args.device, see `DevicePrefetcher`."""
+    return DevicePrefetcher(
+        dataloader,
+        args.device,
+        prefetch=args.device_prefetch,
+        non_blocking=args.dataloader_pin_memory,
+    )
+
+
+def dataset_language_ids(args, model, dataset):
+    """`language_ids` input of every row of `dataset` (look the rows of a
+    batch up with batch[5]) for a model with per-language heads, None for
+    other models."""
+    model = model.module if hasattr(model, "module") else model
+    if not getattr(model, "head_languages", None):
+        return None
+    return model.language_ids(dataset.column("language").tolist()).to(
+        args.device
+    )
+
+
+# sampler position, RNG states and running losses of a checkpoint
+TRAINER_STATE_NAME = "trainer_state.pt"
+
+
+def train(
+    args, train_dataset, model, tokenizer, teacher=None, teacher_logits=None
+):
+    """Train the model, against the soft labels of `teacher` if given, or of
+    `teacher_logits`, the cached teacher logits aligned with
+    `train_dataset` (see `LogitsStore.aligned`)."""
     if args.local_rank in [-1, 0]:
         tb_writer = SummaryWriter()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = (
-        RandomSampler(train_dataset)
-        if args.local_rank == -1
-        else DistributedSampler(train_dataset)
-    )
+    num_replicas = None if args.local_rank != -1 else 1
+    rank = None if args.local_rank != -1 else 0
+    if args.max_tokens_per_batch > 0:
+        # the number of batches is fixed, so t_total below stays exact
+        train_sampler = TokenBudgetBatchSampler(
+            train_dataset.column("lengths"),
+            args.max_tokens_per_batch * max(1, args.n_gpu),
+            num_replicas=num_replicas,
+            rank=rank,
+            seed=args.seed,
+        )
+        batch_sampler = train_sampler
+    else:
+        if args.group_by_length:
+            train_sampler = LengthGroupedSampler(
+                train_dataset.column("lengths"),
+                args.train_batch_size,
+                num_replicas=num_replicas,
+                rank=rank,
+                seed=args.seed,
+            )
+        else:
+            # shuffled from `seed` and the epoch rather than the global RNG,
+            # so a resumed epoch sees the same order
+            train_sampler = DistributedSampler(
+                train_dataset,
+                num_replicas=num_replicas,
+                rank=rank,
+                seed=args.seed,
+            )
+        batch_sampler = BatchSampler(
+            train_sampler, args.train_batch_size, drop_last=False
+        )
+    batch_sampler = SkipBatchSampler(batch_sampler)
     train_dataloader = DataLoader(
-        train_dataset, sampler=train_sampler, batch_size=args.train_batch_size
+        train_dataset,
+        batch_sampler=batch_sampler,
+        collate_fn=get_collator(args, tokenizer),
+        # keeps the loader's seed draws off the global RNG used by dropout
+        generator=torch.Generator(),
+        **dataloader_kwargs(args),
     )
 
     if args.max_steps > 0:
@@ -227,13 +818,15 @@ def train(args, train_dataset, model, tokenizer):
         )
 
     # Prepare optimizer and schedule (linear warmup and decay)
+    # frozen parameters (the encoder in low-rank adaptation mode) get no
+    # optimizer state
     no_decay = ["bias", "LayerNorm.weight"]
     optimizer_grouped_parameters = [
         {
             "params": [
                 p
                 for n, p in model.named_parameters()
-                if not any(nd in n for nd in no_decay)
+                if p.requires_grad and not any(nd in n for nd in no_decay)
             ],
             "weight_decay": args.weight_decay,
         },
@@ -241,7 +834,7 @@ def train(args, train_dataset, model, tokenizer):
             "params": [
                 p
                 for n, p in model.named_parameters()
-                if any(nd in n for nd in no_decay)
+                if p.requires_grad and any(nd in n for nd in no_decay)
             ],
             "weight_decay": 0.0,
         },
@@ -272,28 +865,32 @@ def train(args, train_dataset, model, tokenizer):
             torch.load(os.path.join(args.model_name_or_path, "scheduler.pt"))
         )
 
-    if args.fp16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError(
-                "Please install apex from "
-                + "https://www.github.com/nvidia/apex to use fp16 training."
-            )
-        model, optimizer = amp.initialize(
-            model, optimizer, opt_level=args.fp16_opt_level
+    # Mixed precision: the forward passes run under autocast, fp16 losses
+    # are scaled so small gradients do not underflow (bf16 needs no scaling)
+    scaler = torch.amp.GradScaler("cuda", enabled=args.fp16)
+    if args.fp16 and os.path.isfile(
+        os.path.join(args.model_name_or_path, "scaler.pt")
+    ):
+        scaler.load_state_dict(
+            torch.load(os.path.join(args.model_name_or_path, "scaler.pt"))
         )
 
-    # multi-gpu training (should be after apex fp16 initialization)
+    # multi-gpu training
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
+        if teacher is not None:
+            teacher = torch.nn.DataParallel(teacher)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(
             model,
-            device_ids=[args.local_rank],
-            output_device=args.local_rank,
+            device_ids=[args.local_rank]
+            if args.device.type == "cuda"
+            else None,
+            output_device=args.local_rank
+            if args.device.type == "cuda"
+            else None,
             find_unused_parameters=True,
         )
 
@@ -301,10 +898,17 @@ def train(args, train_dataset, model, tokenizer):
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_dataset))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
-    logger.info(
-        "  Instantaneous batch size per GPU = %d",
-        args.per_gpu_train_batch_size,
-    )
+    if args.max_tokens_per_batch > 0:
+        logger.info(
+            "  Tokens per batch per GPU = %d (%d batches per epoch)",
+            args.max_tokens_per_batch,
+            len(train_dataloader),
+        )
+    else:
+        logger.info(
+            "  Instantaneous batch size per GPU = %d",
+            args.per_gpu_train_batch_size,
+        )
     logger.info(
         "  Total train batch size"
         + "(w. parallel, distributed & accumulation) = %d",
@@ -316,14 +920,36 @@ def train(args, train_dataset, model, tokenizer):
         "  Gradient Accumulation steps = %d", args.gradient_accumulation_steps
     )
     logger.info("  Total optimization steps = %d", t_total)
+    if teacher is not None or teacher_logits is not None:
+        logger.info(
+            "  Distilling from %s (alpha = %s, temperature = %s%s)",
+            args.teacher_model_name_or_path,
+            args.distill_alpha,
+            args.distill_temperature,
+            ", cached logits" if teacher_logits is not None else "",
+        )
+    if teacher is not None:
+        teacher.eval()
 
     global_step = 0
     epochs_trained = 0
-    steps_trained_in_current_epoch = 0
+    batches_trained_in_current_epoch = 0
+    tr_loss, logging_loss = 0.0, 0.0
+    trainer_state = None
+    trainer_state_file = os.path.join(
+        args.model_name_or_path, TRAINER_STATE_NAME
+    )
     # Check if continuing training from a checkpoint
-    if os.path.exists(args.model_name_or_path):
-        # set global_step to global_step of last saved checkpoint
-        # from model path
+    if os.path.isfile(trainer_state_file):
+        trainer_state = torch.load(trainer_state_file, weights_only=False)
+        global_step = trainer_state["global_step"]
+        epochs_trained = trainer_state["epoch"]
+        batches_trained_in_current_epoch = trainer_state["batches_in_epoch"]
+        tr_loss = trainer_state["tr_loss"]
+        logging_loss = trainer_state["logging_loss"]
+    elif os.path.exists(args.model_name_or_path):
+        # checkpoints without a trainer state: set global_step to
+        # global_step of last saved checkpoint from model path
         try:
             global_step = int(
                 args.model_name_or_path.split("-")[-1].split("/")[0]
@@ -333,22 +959,59 @@ def train(args, train_dataset, model, tokenizer):
         epochs_trained = global_step // (
             len(train_dataloader) // args.gradient_accumulation_steps
         )
-        steps_trained_in_current_epoch = global_step % (
-            len(train_dataloader) // args.gradient_accumulation_steps
+        batches_trained_in_current_epoch = (
+            global_step
+            % (len(train_dataloader) // args.gradient_accumulation_steps)
+            * args.gradient_accumulation_steps
         )
-
+    if batches_trained_in_current_epoch >= len(train_dataloader):
+        epochs_trained += 1
+        batches_trained_in_current_epoch = 0
+    if global_step > 0:
         logger.info(
             "  Continuing training from checkpoint, will skip"
-            + "to saved global_step"
+            + " to saved global_step"
         )
         logger.info("  Continuing training from epoch %d", epochs_trained)
         logger.info("  Continuing training from global step %d", global_step)
         logger.info(
-            "  Will skip the first %d steps in the first epoch",
-            steps_trained_in_current_epoch,
+            "  Will skip the first %d batches in the first epoch",
+            batches_trained_in_current_epoch,
         )
-
-    tr_loss, logging_loss = 0.0, 0.0
+    batch_sampler.skip = batches_trained_in_current_epoch
+
+    train_batches = device_batches(args, train_dataloader)
+    language_ids = dataset_language_ids(args, model, train_dataset)
+    monitor = StepMonitor(
+        args.device,
+        metrics_file=(
+            args.metrics_file
+            or os.path.join(args.output_dir, "train_metrics.jsonl")
+        )
+        if args.local_rank in [-1, 0]
+        else None,
+        synchronize_phases=args.profile_phases,
+    )
+    trace_window = (
+        TraceWindow(
+            args.profile_steps[0],
+            args.profile_steps[1],
+            args.profile_dir or os.path.join(args.output_dir, "profile"),
+            args.device,
+        )
+        if args.profile_steps and args.local_rank in [-1, 0]
+        else None
+    )
+    checkpoint_writer = (
+        CheckpointWriter(
+            args.output_dir,
+            save_total_limit=args.save_total_limit,
+            metric_file=TRAINER_STATE_NAME,
+        )
+        if args.local_rank in [-1, 0] and args.save_steps > 0
+        else None
+    )
+    eval_results, eval_step = {}, None
     model.zero_grad()
     train_iterator = trange(
         epochs_trained,
@@ -357,21 +1020,24 @@ def train(args, train_dataset, model, tokenizer):
         disable=args.local_rank not in {-1, 0},
     )
     set_seed(args)  # Added here for reproductibility
-    for _ in train_iterator:
+    if trainer_state is not None:
+        # continue the dropout streams where the checkpoint left them
+        set_rng_state(trainer_state["rng"])
+    for epoch in train_iterator:
+        batch_sampler.set_epoch(epoch)
+        train_dataloader.generator.manual_seed(args.seed + epoch)
+        # step counts the batches of the epoch, skipped ones included, so
+        # gradient accumulation stays in phase after resuming
+        first_step = batch_sampler.skip
         epoch_iterator = tqdm(
-            train_dataloader,
+            train_batches,
             desc="Iteration",
             disable=args.local_rank not in {-1, 0},
         )
-        for step, batch in enumerate(epoch_iterator):
-
-            # Skip past any already trained steps if resuming training
-            if steps_trained_in_current_epoch > 0:
-                steps_trained_in_current_epoch -= 1
-                continue
-
+        for step, batch in enumerate(epoch_iterator, start=first_step):
+            monitor.lap("data")
+            monitor.count_batch(batch[1])
             model.train()
-            batch = tuple(t.to(args.device) for t in batch)
             inputs = {
                 "input_ids": batch[0],
                 "attention_mask": batch[1],
@@ -386,10 +1052,38 @@ def train(args, train_dataset, model, tokenizer):
                     if args.model_type in ["bert", "xlnet", "albert"]
                     else None
                 )
-            outputs = model(**inputs)
+            if language_ids is not None:
+                inputs["language_ids"] = language_ids[batch[5]]
+            with autocast(args):
+                outputs = model(**inputs)
             loss = outputs[
                 0
             ]  # model outputs are always tuple in transformers (see doc)
+            if teacher_logits is not None:
+                rows = batch[5].cpu().numpy()
+                teacher_outputs = (None,) + tuple(
+                    torch.from_numpy(teacher_logits[name][rows]).to(
+                        args.device
+                    )
+                    for name in ("logits_a", "logits_b")
+                )
+            elif teacher is not None:
+                with torch.no_grad(), autocast(args):
+                    teacher_outputs = teacher(
+                        **{
+                            k: v
+                            for k, v in inputs.items()
+                            if not k.startswith("labels")
+                        }
+                    )
+            if teacher is not None or teacher_logits is not None:
+                loss = distillation_loss(
+                    loss,
+                    outputs[1:3],
+                    teacher_outputs[1:3],
+                    args.distill_alpha,
+                    args.distill_temperature,
+                )
 
             if args.n_gpu > 1:
                 loss = (
@@ -397,28 +1091,28 @@ def train(args, train_dataset, model, tokenizer):
                 )  # mean() to average on multi-gpu parallel training
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
+            monitor.lap("forward")
 
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
+            scaler.scale(loss).backward()
 
             tr_loss += loss.item()
+            monitor.lap("backward")
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(
-                        amp.master_params(optimizer), args.max_grad_norm
-                    )
-                else:
-                    torch.nn.utils.clip_grad_norm_(
-                        model.parameters(), args.max_grad_norm
-                    )
+                # clip the true gradients, not the scaled ones
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(
+                    model.parameters(), args.max_grad_norm
+                )
+                monitor.lap("clip")
 
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()  # Update learning rate schedule
                 model.zero_grad()
                 global_step += 1
+                monitor.lap("optimizer")
+                if trace_window is not None:
+                    trace_window.step(global_step)
 
                 if (
                     args.local_rank in [-1, 0]
@@ -430,14 +1124,22 @@ def train(args, train_dataset, model, tokenizer):
                         args.local_rank == -1 and args.evaluate_during_training
                     ):  # Only evaluate when single GPU
                         # otherwise metrics may not average well
+                        results = {}
                         try:
-                            results = evaluate(args, model, tokenizer,label_list,)
+                            results = evaluate(
+                                args,
+                                model,
+                                tokenizer,
+                                processors[args.task_name]().get_labels(),
+                            )
                         except Exception as ex:
                             print(ex, "train-evaluate")
                             traceback.print_stack()
                         for key, value in results.items():
                             eval_key = "eval_{}".format(key)
                             logs[eval_key] = value
+                        eval_results, eval_step = results, global_step
+                        monitor.lap("eval")
 
                     loss_scalar = (tr_loss - logging_loss) / args.logging_steps
                     learning_rate_scalar = scheduler.get_lr()[0]
@@ -445,6 +1147,8 @@ def train(args, train_dataset, model, tokenizer):
                     logs["loss"] = loss_scalar
                     logging_loss = tr_loss
 
+                    for key, value in monitor.report(global_step).items():
+                        tb_writer.add_scalar("perf/" + key, value, global_step)
                     for key, value in logs.items():
                         tb_writer.add_scalar(key, value, global_step)
                     print(json.dumps({**logs, **{"step": global_step}}))
@@ -454,50 +1158,224 @@ def train(args, train_dataset, model, tokenizer):
                     and args.save_steps > 0
                     and global_step % args.save_steps == 0
                 ):
-                    # Save model checkpoint
-                    output_dir = os.path.join(
-                        args.output_dir, "checkpoint-{}".format(global_step)
-                    )
-                    if not os.path.exists(output_dir):
-                        os.makedirs(output_dir)
+                    # Snapshot the checkpoint, it is written in the background
+                    metric = None
+                    if args.save_best_metric:
+                        if eval_step != global_step:
+                            eval_results = evaluate(
+                                args,
+                                model,
+                                tokenizer,
+                                processors[args.task_name]().get_labels(),
+                            )
+                            eval_step = global_step
+                            monitor.lap("eval")
+                        if args.save_best_metric not in eval_results:
+                            raise ValueError(
+                                "Unknown --save_best_metric %s, evaluation reports %s"
+                                % (
+                                    args.save_best_metric,
+                                    ", ".join(sorted(eval_results)),
+                                )
+                            )
+                        metric = eval_results[args.save_best_metric]
                     model_to_save = (
                         model.module if hasattr(model, "module") else model
                     )  # Take care of distributed/parallel training
-                    model_to_save.save_pretrained(output_dir)
-                    tokenizer.save_pretrained(output_dir)
-
-                    torch.save(
-                        args, os.path.join(output_dir, "training_args.bin")
-                    )
-                    logger.info("Saving model checkpoint to %s", output_dir)
-
-                    torch.save(
-                        optimizer.state_dict(),
-                        os.path.join(output_dir, "optimizer.pt"),
-                    )
-                    torch.save(
-                        scheduler.state_dict(),
-                        os.path.join(output_dir, "scheduler.pt"),
+                    states = {
+                        "training_args.bin": args,
+                        "optimizer.pt": optimizer.state_dict(),
+                        "scheduler.pt": scheduler.state_dict(),
+                        TRAINER_STATE_NAME: {
+                            "global_step": global_step,
+                            "epoch": epoch,
+                            "batches_in_epoch": step + 1,
+                            "tr_loss": tr_loss,
+                            "logging_loss": logging_loss,
+                            "rng": get_rng_state(),
+                            "metric": metric,
+                        },
+                    }
+                    if args.fp16:
+                        states["scaler.pt"] = scaler.state_dict()
+                    checkpoint_writer.save(
+                        global_step, model_to_save, tokenizer, states, metric
                     )
                     logger.info(
-                        "Saving optimizer and scheduler states to %s",
-                        output_dir,
+                        "Saving model checkpoint %d in the background",
+                        global_step,
                     )
+                    monitor.lap("save")
 
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
+        batch_sampler.skip = 0
         if args.max_steps > 0 and global_step > args.max_steps:
             train_iterator.close()
             break
 
+    if trace_window is not None:
+        trace_window.stop()
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
     if args.local_rank in [-1, 0]:
         tb_writer.close()
+    logger.info("  Waited %.1fs on training data", train_batches.wait_time)
 
     return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, label_list, prefix=""):
+class PredictionBuffer(object):
+    """Fixed-size array the evaluation loop copies batch outputs into.
+
+    Replaces growing the outputs with `np.append`, which copies everything
+    collected so far on every batch. With `path` the array is a .npy file
+    memory-mapped from disk, so the outputs are streamed out as they come.
+    """
+
+    def __init__(self, num_rows, path=None):
+        self.num_rows = num_rows
+        self.path = path
+        self.array = None
+        self.size = 0
+
+    def append(self, values):
+        if self.array is None:
+            shape = (self.num_rows,) + values.shape[1:]
+            if self.path:
+                self.array = np.lib.format.open_memmap(
+                    self.path, mode="w+", dtype=values.dtype, shape=shape
+                )
+            else:
+                self.array = np.empty(shape, dtype=values.dtype)
+        self.array[self.size : self.size + len(values)] = values
+        self.size += len(values)
+
+    @property
+    def values(self):
+        """The rows written so far (None before the first batch)."""
+        if self.array is None:
+            return None
+        return self.array[: self.size]
+
+
+def get_eval_dataloader(args, eval_dataset, tokenizer):
+    """Batches `eval_dataset` in order."""
+    args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
+    # Note that DistributedSampler samples randomly
+    if args.max_tokens_per_batch > 0:
+        # packs consecutive examples, predictions stay in dataset order
+        return DataLoader(
+            eval_dataset,
+            batch_sampler=TokenBudgetBatchSampler(
+                eval_dataset.column("lengths"),
+                args.max_tokens_per_batch * max(1, args.n_gpu),
+                num_replicas=1,
+                rank=0,
+                shuffle=False,
+            ),
+            collate_fn=get_collator(args, tokenizer),
+            **dataloader_kwargs(args, persistent=False),
+        )
+    return DataLoader(
+        eval_dataset,
+        sampler=SequentialSampler(eval_dataset),
+        batch_size=args.eval_batch_size,
+        collate_fn=get_collator(args, tokenizer),
+        **dataloader_kwargs(args, persistent=False),
+    )
+
+
+LOGITS_DIR_NAME = "logits"
+
+
+def get_logits_dir(args, model_dir):
+    """Where the logits of the model in `model_dir` are cached. Under
+    --logits_dir every model gets its own store, named after its directory,
+    so the checkpoints of --eval_all_checkpoints never share logits."""
+    if args.logits_dir:
+        return os.path.join(
+            args.logits_dir, os.path.basename(os.path.normpath(model_dir))
+        )
+    return os.path.join(model_dir, LOGITS_DIR_NAME)
+
+
+def cache_logits(args, model, tokenizer, mode, logits_dir):
+    """Runs `model` once over the `mode` split and stores its logits_a,
+    logits_b and, with --cache_pooled_outputs, pooled outputs as .npy files
+    in `logits_dir`/`mode`, next to the ID and language of every example.
+    Read them back with `LogitsStore`."""
+    dataset = load_and_cache_examples(args, args.task_name, tokenizer, mode)
+    dataloader = DataLoader(
+        dataset,
+        sampler=SequentialSampler(dataset),
+        batch_size=args.per_gpu_eval_batch_size,
+        collate_fn=get_collator(args, tokenizer),
+        **dataloader_kwargs(args, persistent=False),
+    )
+    store_dir = os.path.join(logits_dir, mode)
+    tmp_dir = "{}.tmp-{}".format(store_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    names = ["logits_a", "logits_b"]
+    pooled = []
+    hook = None
+    if args.cache_pooled_outputs:
+        names.append("pooled")
+        hook = model.bert.pooler.register_forward_hook(
+            lambda module, inputs, output: pooled.append(output)
+        )
+    buffers = {
+        name: PredictionBuffer(
+            len(dataset), os.path.join(tmp_dir, name + ".npy")
+        )
+        for name in names
+    }
+    logger.info("***** Caching %s logits in %s *****", mode, store_dir)
+    model.eval()
+    language_ids = dataset_language_ids(args, model, dataset)
+    for batch in tqdm(device_batches(args, dataloader), desc="Caching logits"):
+        inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
+        if args.model_type != "distilbert":
+            inputs["token_type_ids"] = (
+                batch[2] if args.model_type in ["bert", "xlnet", "albert"] else None
+            )
+        if language_ids is not None:
+            inputs["language_ids"] = language_ids[batch[5]]
+        with torch.no_grad():
+            outputs = model(**inputs)
+        buffers["logits_a"].append(outputs[1].cpu().numpy())
+        buffers["logits_b"].append(outputs[2].cpu().numpy())
+        if pooled:
+            # the last pooler call is the one feeding the final heads
+            buffers["pooled"].append(pooled[-1].cpu().numpy())
+            del pooled[:]
+    if hook is not None:
+        hook.remove()
+    for buffer in buffers.values():
+        if buffer.array is not None:
+            buffer.array.flush()
+    for name in ("guid", "language"):
+        np.save(os.path.join(tmp_dir, name + ".npy"), dataset.column(name))
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "model": args.model_name_or_path,
+                "mode": mode,
+                "num_examples": len(dataset),
+                "arrays": names,
+            },
+            f,
+        )
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+    return store_dir
+
+
+def evaluate(args, model, tokenizer, label_list, prefix="", logits_dir=None):
+    """Evaluates `model`, or the logits it cached in `logits_dir` with
+    --do_cache_logits if there are any for the split."""
     # Loop to handle MNLI double evaluation (matched, mis-matched)
     eval_task_names = (
         ("mnli", "mnli-mm") if args.task_name == "mnli" else (args.task_name,)
@@ -509,26 +1387,13 @@ def evaluate(args, model, tokenizer, label_list, prefix=""):
     )
     results = {}
     for eval_task, eval_output_dir in zip(eval_task_names, eval_outputs_dirs):
-        if args.do_eval:
-            eval_dataset = load_and_cache_examples(
-                args, eval_task, tokenizer, "dev"
-            )
-        else:
-            eval_dataset = load_and_cache_examples(
-                args, eval_task, tokenizer, "test"
-            )
+        mode = "dev" if args.do_eval else "test"
+        eval_dataset = load_and_cache_examples(args, eval_task, tokenizer, mode)
 
         if not os.path.exists(eval_output_dir) and args.local_rank in {-1, 0}:
             os.makedirs(eval_output_dir)
 
-        args.eval_batch_size = args.per_gpu_eval_batch_size * max(
-            1, args.n_gpu
-        )
-        # Note that DistributedSampler samples randomly
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(
-            eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size
-        )
+        eval_dataloader = get_eval_dataloader(args, eval_dataset, tokenizer)
 
         # multi-gpu eval
         if args.n_gpu > 1 and not isinstance(model, torch.nn.DataParallel):
@@ -540,61 +1405,83 @@ def evaluate(args, model, tokenizer, label_list, prefix=""):
         logger.info("  Batch size = %d", args.eval_batch_size)
         eval_loss = 0.0
         nb_eval_steps = 0
-        preds_a = None
-        preds_b = None
-        out_label_ids = None
-        for batch in tqdm(eval_dataloader, desc="Evaluating"):
-            try:
-                model.eval()
-                batch = tuple(t.to(args.device) for t in batch)
-
-                with torch.no_grad():
-                    inputs = {
-                        "input_ids": batch[0],
-                        "attention_mask": batch[1],
-                        "labels_a": batch[3],
-                        "labels_b": batch[4],
-                    }
-                    if args.model_type != "distilbert":
-                        # XLM, DistilBERT, RoBERTa,
-                        # and XLM-RoBERTa don't use segment_ids
-                        inputs["token_type_ids"] = (
-                            batch[2]
-                            if args.model_type in ["bert", "xlnet", "albert"]
-                            else None
-                        )
-                    outputs = model(**inputs)
-                    tmp_eval_loss, logits_a, logits_b = outputs[:3]
-
-                    eval_loss += tmp_eval_loss.mean().item()
-                nb_eval_steps += 1
-                if preds_a is None:
-                    preds_a = logits_a.detach().cpu().numpy()
-                    preds_b = logits_b.detach().cpu().numpy()
-                    out_label_ids_a = inputs["labels_a"].detach().cpu().numpy()
-                    out_label_ids_b = inputs["labels_b"].detach().cpu().numpy()
-                else:
-                    preds_a = np.append(
-                        preds_a, logits_a.detach().cpu().numpy(), axis=0
-                    )
-                    preds_b = np.append(
-                        preds_b, logits_b.detach().cpu().numpy(), axis=0
-                    )
-                    out_label_ids_a = np.append(
-                        out_label_ids_a,
-                        inputs["labels_a"].detach().cpu().numpy(),
-                        axis=0,
-                    )
-                    out_label_ids_b = np.append(
-                        out_label_ids_b,
-                        inputs["labels_b"].detach().cpu().numpy(),
-                        axis=0,
-                    )
-            except Exception as ex:
-                print(ex, "evaluate")
-                traceback.print_stack()
+        stream_dir = (
+            os.path.join(eval_output_dir, prefix)
+            if args.stream_predictions
+            else None
+        )
+        if stream_dir:
+            os.makedirs(stream_dir, exist_ok=True)
+        buffers = {
+            name: PredictionBuffer(
+                len(eval_dataset),
+                os.path.join(stream_dir, name + ".npy")
+                if stream_dir and name.startswith("logits")
+                else None,
+            )
+            for name in ("logits_a", "logits_b", "labels_a", "labels_b")
+        }
+        if logits_dir and not os.path.isdir(os.path.join(logits_dir, mode)):
+            logger.info("  No cached %s logits in %s", mode, logits_dir)
+            logits_dir = None
+        if logits_dir:
+            # scored once by --do_cache_logits, the model is not run
+            logger.info("  Reading the logits from %s", logits_dir)
+            cached = LogitsStore(os.path.join(logits_dir, mode)).aligned(
+                eval_dataset
+            )
+            for task in ("a", "b"):
+                buffers["logits_" + task].append(cached["logits_" + task])
+                buffers["labels_" + task].append(
+                    eval_dataset.column("label_" + task).astype(np.int64)
+                )
+        else:
+            eval_batches = device_batches(args, eval_dataloader)
+            language_ids = dataset_language_ids(args, model, eval_dataset)
+            for batch in tqdm(eval_batches, desc="Evaluating"):
+                try:
+                    model.eval()
+
+                    with torch.no_grad():
+                        inputs = {
+                            "input_ids": batch[0],
+                            "attention_mask": batch[1],
+                            "labels_a": batch[3],
+                            "labels_b": batch[4],
+                        }
+                        if args.model_type != "distilbert":
+                            # XLM, DistilBERT, RoBERTa,
+                            # and XLM-RoBERTa don't use segment_ids
+                            inputs["token_type_ids"] = (
+                                batch[2]
+                                if args.model_type in ["bert", "xlnet", "albert"]
+                                else None
+                            )
+                        if language_ids is not None:
+                            inputs["language_ids"] = language_ids[batch[5]]
+                        outputs = model(**inputs)
+                        tmp_eval_loss, logits_a, logits_b = outputs[:3]
+
+                        eval_loss += tmp_eval_loss.mean().item()
+                    nb_eval_steps += 1
+                    for name, values in (
+                        ("logits_a", logits_a),
+                        ("logits_b", logits_b),
+                        ("labels_a", inputs["labels_a"]),
+                        ("labels_b", inputs["labels_b"]),
+                    ):
+                        buffers[name].append(values.detach().cpu().numpy())
+                except Exception as ex:
+                    print(ex, "evaluate")
+                    traceback.print_stack()
+            logger.info("  Waited %.1fs on evaluation data", eval_batches.wait_time)
+        preds_a = buffers["logits_a"].values
+        preds_b = buffers["logits_b"].values
+        out_label_ids_a = buffers["labels_a"].values
+        out_label_ids_b = buffers["labels_b"].values
         try:
-            eval_loss = eval_loss / nb_eval_steps
+            if nb_eval_steps:
+                eval_loss = eval_loss / nb_eval_steps
             if args.output_mode == "classification":
                 preds_a = np.argmax(preds_a, axis=1)
                 preds_b = np.argmax(preds_b, axis=1)
@@ -638,91 +1525,214 @@ def evaluate(args, model, tokenizer, label_list, prefix=""):
     return results
 
 
-def load_and_cache_examples(args, task, tokenizer, mode):
-    if args.local_rank not in [-1, 0] and not mode in ("dev", "test"):
-        torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
+def evaluate_ensemble(args, checkpoints, tokenizer, label_list):
+    """Averages the probabilities of both heads of the models in
+    `checkpoints` on the dev (--do_eval) or test set and writes them to a
+    single ensemble_predictions*.csv.
 
-    processor = processors[task]()
-    output_mode = output_modes[task]
-    # Load data features from cache or dataset file
-    cached_features_file = os.path.join(
-        args.data_dir,
-        "cached_{}_{}_{}_{}".format(
-            mode,
-            list(filter(None, args.model_name_or_path.split("/"))).pop(),
-            str(args.max_seq_length),
-            str(task),
-        ),
-    )
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
-        logger.info(
-            "Loading features from cached file %s", cached_features_file
-        )
-        features = torch.load(cached_features_file)
+    The set is featurized once. By default all models are kept in memory
+    and every batch goes through each of them; with --ensemble_lazy the
+    models are loaded one at a time and each makes its own pass. With
+    --quantize every model is quantized as it is loaded.
+    """
+    if args.quantize:
+        # dynamically quantized kernels only exist for CPU
+        args.device = torch.device("cpu")
+        args.n_gpu = 0
+    mode = "dev" if args.do_eval else "test"
+    eval_dataset = load_and_cache_examples(
+        args, args.task_name, tokenizer, mode
+    )
+    eval_dataloader = get_eval_dataloader(args, eval_dataset, tokenizer)
+    probs = {
+        task: np.zeros((len(eval_dataset), len(label_list[task])), np.float32)
+        for task in ("a", "b")
+    }
+
+    def load(checkpoint):
+        model = MultiHeadClassification.from_pretrained(checkpoint)
+        model.early_exit_threshold = args.early_exit_threshold
+        if args.quantize:
+            model = quantize_model(model)
+        model.to(args.device)
+        model.eval()
+        return model
+
+    def accumulate(models, desc):
+        models_language_ids = [
+            dataset_language_ids(args, model, eval_dataset) for model in models
+        ]
+        for batch in tqdm(device_batches(args, eval_dataloader), desc=desc):
+            rows = batch[5].cpu().numpy()
+            inputs = {"input_ids": batch[0], "attention_mask": batch[1]}
+            if args.model_type != "distilbert":
+                inputs["token_type_ids"] = (
+                    batch[2]
+                    if args.model_type in ["bert", "xlnet", "albert"]
+                    else None
+                )
+            with torch.no_grad():
+                for model, language_ids in zip(models, models_language_ids):
+                    if language_ids is not None:
+                        inputs["language_ids"] = language_ids[batch[5]]
+                    outputs = model(**inputs)
+                    for task, logits in (("a", outputs[1]), ("b", outputs[2])):
+                        if args.output_mode == "classification":
+                            logits = torch.softmax(logits, dim=-1)
+                        probs[task][rows] += logits.cpu().numpy()
+
+    logger.info("***** Running ensemble evaluation *****")
+    logger.info("  Checkpoints = %s", checkpoints)
+    logger.info("  Num examples = %d", len(eval_dataset))
+    if args.ensemble_lazy:
+        for checkpoint in checkpoints:
+            accumulate([load(checkpoint)], "Evaluating " + checkpoint)
     else:
-        logger.info("Creating features from dataset file at %s", args.data_dir)
-        label_list = processor.get_labels()
-        if task in ["mnli", "mnli-mm"] and args.model_type in [
-            "roberta",
-            "xlmroberta",
-        ]:
-            # HACK(label indices are swapped in RoBERTa pretrained model)
-            label_list[1], label_list[2] = label_list[2], label_list[1]
-        examples = processor.get_examples(args.data_dir, mode, args.folder_list)
-        features = convert_examples_to_features(
-            examples,
-            tokenizer,
-            label_list=label_list,
-            max_seq_length=args.max_seq_length,
-            output_mode=output_mode,
-            pad_on_left=bool(
-                args.model_type in ["xlnet"]
-            ),  # pad on the left for xlnet
-            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[
-                0
-            ],
-            pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+        accumulate([load(checkpoint) for checkpoint in checkpoints], "Evaluating")
+
+    results, preds = {}, {}
+    for task in ("a", "b"):
+        probs[task] /= len(checkpoints)
+        if args.output_mode == "classification":
+            preds[task] = np.argmax(probs[task], axis=1)
+        else:
+            preds[task] = np.squeeze(probs[task])
+        if args.do_eval:
+            result = compute_metrics(
+                args.task_name, preds[task], eval_dataset.column("label_" + task)
+            )
+            results.update({k + "_" + task: v for k, v in result.items()})
+    if args.do_eval:
+        output_eval_file = os.path.join(
+            args.output_dir, "ensemble_eval_results.txt"
         )
-        if args.local_rank in [-1, 0]:
-            logger.info(
-                "Saving features into cached file %s", cached_features_file
+        with open(output_eval_file, "w") as writer:
+            logger.info("***** Ensemble eval results *****")
+            for key in sorted(results.keys()):
+                logger.info("  %s = %s", key, str(results[key]))
+                writer.write("%s = %s\n" % (key, str(results[key])))
+
+    output_predictions_file = os.path.join(
+        args.output_dir,
+        "ensemble_predictions" + "_".join(args.folder_list or []) + ".csv",
+    )
+    with open(output_predictions_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["ID", "language", "label_a", "label_b"]
+            + ["prob_a_" + label for label in label_list["a"]]
+            + ["prob_b_" + label for label in label_list["b"]]
+        )
+        for row, (guid, language) in enumerate(
+            zip(eval_dataset.column("guid"), eval_dataset.column("language"))
+        ):
+            writer.writerow(
+                [guid, language]
+                + [
+                    label_list[task][preds[task][row]]
+                    if args.output_mode == "classification"
+                    else preds[task][row]
+                    for task in ("a", "b")
+                ]
+                + ["%.6f" % p for p in probs["a"][row]]
+                + ["%.6f" % p for p in probs["b"][row]]
             )
-            torch.save(features, cached_features_file)
+    logger.info("Saved ensemble predictions to %s", output_predictions_file)
+    return results
 
-    if args.local_rank == 0 and not evaluate:
+
+def load_and_cache_examples(args, task, tokenizer, mode):
+    if args.local_rank not in [-1, 0] and not mode in ("dev", "test"):
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor(
-        [f.input_ids for f in features], dtype=torch.long
+    processor = processors[task]()
+    output_mode = output_modes[task]
+    label_list = processor.get_labels()
+    if task in ["mnli", "mnli-mm"] and args.model_type in [
+        "roberta",
+        "xlmroberta",
+    ]:
+        # HACK(label indices are swapped in RoBERTa pretrained model)
+        label_list[1], label_list[2] = label_list[2], label_list[1]
+    convert_options = dict(
+        label_list=label_list,
+        max_seq_length=args.max_seq_length,
+        output_mode=output_mode,
+        pad_on_left=bool(
+            args.model_type in ["xlnet"]
+        ),  # pad on the left for xlnet
+        pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+        pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+        # padded per batch by DynamicPaddingCollator
+        pad_to_max_length=False,
     )
-    all_attention_mask = torch.tensor(
-        [f.input_mask for f in features], dtype=torch.long
+    # Load data features from cache or dataset file. Every (language, split)
+    # unit is cached on its own, keyed by everything its features depend on,
+    # so only new or changed CSVs are featurized.
+    cache_dir = args.features_cache_dir or os.path.join(
+        args.data_dir, "cached_features"
     )
-    all_token_type_ids = torch.tensor(
-        [f.segment_ids for f in features], dtype=torch.long
+    options_key = feature_options_key(
+        tokenizer_fingerprint(tokenizer),
+        {"task": task, "mode": mode, **convert_options},
     )
-    if output_mode == "classification":
-        all_labels_a = torch.tensor(
-            [f.label_a for f in features], dtype=torch.long
-        )
-        all_labels_b = torch.tensor(
-            [f.label_b for f in features], dtype=torch.long
+    datasets, cached_features_dirs = [], []
+    for language in args.folder_list or processor.folder_list:
+        dataset_file = processor.get_dataset_file(
+            args.data_dir, language, mode
         )
-    elif output_mode == "regression":
-        all_labels_a = torch.tensor(
-            [f.label_a for f in features], dtype=torch.float
+        if not os.path.exists(dataset_file):
+            print(dataset_file, "doesn't exist")
+            continue
+        data_hash = file_digest(dataset_file)
+        cached_features_dir = os.path.join(
+            cache_dir,
+            "{}_{}_{}".format(
+                mode, language, feature_cache_key(data_hash, options_key)
+            ),
         )
-        all_labels_b = torch.tensor(
-            [f.label_b for f in features], dtype=torch.float
+        if os.path.isdir(cached_features_dir) and not args.overwrite_cache:
+            logger.info(
+                "Loading features from cached file %s", cached_features_dir
+            )
+            dataset = FeatureDataset.load(cached_features_dir)
+        else:
+            logger.info("Creating features from dataset file at %s", dataset_file)
+            examples = processor.get_examples(args.data_dir, mode, [language])
+            features = convert_examples_to_features_parallel(
+                examples,
+                tokenizer,
+                num_workers=args.preprocessing_num_workers,
+                **convert_options,
+            )
+            dataset = FeatureDataset(
+                features_to_columns(features, output_mode), language=language
+            )
+            if args.local_rank in [-1, 0]:
+                logger.info(
+                    "Saving features into cached file %s", cached_features_dir
+                )
+                os.makedirs(cache_dir, exist_ok=True)
+                dataset.save(
+                    cached_features_dir,
+                    mode=mode,
+                    options_key=options_key,
+                    data=data_hash,
+                )
+                invalidate_feature_unit(cache_dir, cached_features_dir)
+        datasets.append(dataset)
+        cached_features_dirs.append(cached_features_dir)
+    if args.local_rank in [-1, 0]:
+        evict_feature_cache(
+            cache_dir,
+            args.features_cache_size_limit * 2 ** 20,
+            keep=cached_features_dirs,
         )
-    dataset = TensorDataset(
-        all_input_ids,
-        all_attention_mask,
-        all_token_type_ids,
-        all_labels_a,
-        all_labels_b,
-    )
+    dataset = FeatureDataset.concat(datasets)
+
+    if args.local_rank == 0 and not mode in ("dev", "test"):
+        torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
+
     return dataset
 
 
@@ -799,7 +1809,52 @@ def main():
         default=128,
         type=int,
         help="The maximum total input sequence length after tokenization. Sequences longer "
-        "than this will be truncated, sequences shorter will be padded.",
+        "than this will be truncated, batches are padded to their longest sequence.",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Batch training examples of similar length together to reduce padding.",
+    )
+    parser.add_argument(
+        "--preprocessing_num_workers",
+        default=1,
+        type=int,
+        help="Number of processes used to convert examples to features.",
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        default=0,
+        type=int,
+        help="Number of DataLoader worker processes (0 loads batches in the main process).",
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        default=2,
+        type=int,
+        help="Batches loaded in advance by each DataLoader worker.",
+    )
+    parser.add_argument(
+        "--dataloader_persistent_workers",
+        action="store_true",
+        help="Keep the training DataLoader workers alive between epochs.",
+    )
+    parser.add_argument(
+        "--dataloader_pin_memory",
+        action="store_true",
+        help="Collate batches into pinned memory and copy them to the GPU asynchronously.",
+    )
+    parser.add_argument(
+        "--device_prefetch",
+        default=0,
+        type=int,
+        help="If > 0: a background thread moves up to this many batches to the device "
+        "ahead of the training/evaluation loop.",
+    )
+    parser.add_argument(
+        "--no_fast_tokenizer",
+        action="store_true",
+        help="Use the python tokenizer even if a fast (Rust) one is available",
     )
     parser.add_argument(
         "--do_train", action="store_true", help="Whether to run training."
@@ -819,11 +1874,92 @@ def main():
         action="store_true",
         help="Run evaluation during training at each logging step.",
     )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Evaluate/predict on CPU with an int8 dynamically quantized model, "
+        "saved to <checkpoint>/quantized.",
+    )
+    parser.add_argument(
+        "--stream_predictions",
+        action="store_true",
+        help="Write evaluation logits to logits_a.npy/logits_b.npy in the output dir "
+        "while evaluating instead of keeping them in memory.",
+    )
     parser.add_argument(
         "--do_lower_case",
         action="store_true",
         help="Set this flag if you are using an uncased model.",
     )
+    parser.add_argument(
+        "--do_cache_logits",
+        action="store_true",
+        help="Run model_name_or_path once over --cache_logits_splits and store its logits.",
+    )
+    parser.add_argument(
+        "--cache_logits_splits",
+        default=["train"],
+        type=str,
+        nargs="*",
+        help="Splits --do_cache_logits runs on.",
+    )
+    parser.add_argument(
+        "--cache_pooled_outputs",
+        action="store_true",
+        help="Also store the pooled outputs with --do_cache_logits.",
+    )
+    parser.add_argument(
+        "--logits_dir",
+        default="",
+        type=str,
+        help="Where logits are cached, in <logits_dir>/<model dir name>/<split> "
+        "(default: <model dir>/logits/<split>).",
+    )
+    parser.add_argument(
+        "--use_cached_logits",
+        action="store_true",
+        help="Distill from the cached logits of the teacher and evaluate the cached logits "
+        "of the checkpoints instead of running the models.",
+    )
+    parser.add_argument(
+        "--early_exit_layers",
+        default=None,
+        type=int,
+        nargs="*",
+        help="Train intermediate heads for both tasks after these (1-based) encoder layers.",
+    )
+    parser.add_argument(
+        "--early_exit_threshold",
+        default=0.0,
+        type=float,
+        help="If > 0: at evaluation, stop at the first exit where both heads reach this "
+        "softmax probability.",
+    )
+    parser.add_argument(
+        "--teacher_model_name_or_path",
+        default="",
+        type=str,
+        help="Trained model whose soft logits of both heads the model is distilled from.",
+    )
+    parser.add_argument(
+        "--student_num_hidden_layers",
+        default=0,
+        type=int,
+        help="If > 0: train a student keeping this many evenly spaced layers of "
+        "model_name_or_path (e.g. the teacher itself).",
+    )
+    parser.add_argument(
+        "--distill_alpha",
+        default=0.5,
+        type=float,
+        help="Weight of the soft teacher loss, 1 - alpha weights the hard label loss.",
+    )
+    parser.add_argument(
+        "--distill_temperature",
+        default=2.0,
+        type=float,
+        help="Softmax temperature of the teacher and student logits.",
+    )
 
     parser.add_argument(
         "--per_gpu_train_batch_size",
@@ -837,6 +1973,13 @@ def main():
         type=int,
         help="Batch size per GPU/CPU for evaluation.",
     )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        default=0,
+        type=int,
+        help="If > 0: build batches of at most this many (padded) tokens per GPU/CPU "
+        "instead of a fixed number of examples. Overrides the per_gpu batch sizes.",
+    )
     parser.add_argument(
         "--gradient_accumulation_steps",
         type=int,
@@ -889,22 +2032,119 @@ def main():
         default=500,
         help="Log every X updates steps.",
     )
+    parser.add_argument(
+        "--metrics_file",
+        default="",
+        type=str,
+        help="JSON lines file for the per-phase times, throughput, padding and memory logged "
+        "every logging step (default: OUTPUT_DIR/train_metrics.jsonl).",
+    )
+    parser.add_argument(
+        "--profile_phases",
+        action="store_true",
+        help="Synchronize CUDA after every phase of the training loop so the "
+        "phase times include their kernels (slows training down).",
+    )
+    parser.add_argument(
+        "--profile_steps",
+        default=None,
+        type=int,
+        nargs=2,
+        metavar=("START", "END"),
+        help="Record a torch.profiler trace from optimization step START to END.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        default="",
+        type=str,
+        help="Where to write the --profile_steps trace (default: OUTPUT_DIR/profile).",
+    )
+    parser.add_argument(
+        "--language_heads",
+        action="store_true",
+        help="Train one shared encoder with a classifier_a/classifier_b pair "
+        "per language of --folder_list, picked by each example's language.",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Recompute the encoder activations in the backward pass to save memory.",
+    )
+    parser.add_argument(
+        "--lora_rank",
+        default=0,
+        type=int,
+        help="Freeze the encoder and train rank-r low-rank updates of it "
+        "(and the heads) instead; only these are saved.",
+    )
+    parser.add_argument("--lora_alpha", default=16.0, type=float)
+    parser.add_argument("--lora_dropout", default=0.1, type=float)
+    parser.add_argument(
+        "--lora_target_modules",
+        default=["query", "value"],
+        type=str,
+        nargs="+",
+        help="Linear layers of the encoder layers adapted with --lora_rank.",
+    )
     parser.add_argument(
         "--save_steps",
         type=int,
         default=500,
         help="Save checkpoint every X updates steps.",
     )
+    parser.add_argument(
+        "--save_total_limit",
+        type=int,
+        default=0,
+        help="Keep only the last X checkpoints (0 keeps all).",
+    )
+    parser.add_argument(
+        "--save_best_metric",
+        default="",
+        type=str,
+        help="Evaluate on the dev set at every checkpoint and also keep the one "
+        "with the best value of this metric (e.g. f1_a) when pruning. Needs --do_eval.",
+    )
     parser.add_argument(
         "--eval_all_checkpoints",
         action="store_true",
         help="Evaluate all checkpoints starting with the same prefix as model_name ending and ending with step number",
     )
+    parser.add_argument(
+        "--ensemble",
+        action="store_true",
+        help="Average the predictions of the evaluated checkpoints (or of "
+        "--ensemble_checkpoints) into one ensemble_predictions*.csv.",
+    )
+    parser.add_argument(
+        "--ensemble_checkpoints",
+        default=None,
+        type=str,
+        nargs="*",
+        help="Model directories to ensemble, sharing the tokenizer of output_dir.",
+    )
+    parser.add_argument(
+        "--ensemble_lazy",
+        action="store_true",
+        help="Load the ensembled models one at a time instead of keeping all in memory.",
+    )
     parser.add_argument(
         "--no_cuda",
         action="store_true",
         help="Avoid using CUDA when available",
     )
+    parser.add_argument(
+        "--num_processes",
+        type=int,
+        default=0,
+        help="Spawn this many local processes for CPU distributed training (gloo backend)",
+    )
+    parser.add_argument(
+        "--threads_per_rank",
+        type=int,
+        default=0,
+        help="Intra-op threads of every CPU process (default: the cores divided among the local processes)",
+    )
     parser.add_argument(
         "--overwrite_output_dir",
         action="store_true",
@@ -915,6 +2155,18 @@ def main():
         action="store_true",
         help="Overwrite the cached training and evaluation sets",
     )
+    parser.add_argument(
+        "--features_cache_dir",
+        default="",
+        type=str,
+        help="Where to cache converted features (default: DATA_DIR/cached_features)",
+    )
+    parser.add_argument(
+        "--features_cache_size_limit",
+        default=0,
+        type=int,
+        help="Evict least recently used cached features above this size in MB (0: no limit)",
+    )
     parser.add_argument(
         "--seed", type=int, default=42, help="random seed for initialization"
     )
@@ -922,14 +2174,12 @@ def main():
     parser.add_argument(
         "--fp16",
         action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        help="Train with float16 mixed precision (torch autocast and loss scaling, CUDA only)",
     )
     parser.add_argument(
-        "--fp16_opt_level",
-        type=str,
-        default="O1",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-        "See details at https://nvidia.github.io/apex/amp.html",
+        "--bf16",
+        action="store_true",
+        help="Train with bfloat16 mixed precision (torch autocast, CPU or GPU)",
     )
     parser.add_argument(
         "--local_rank",
@@ -968,18 +2218,62 @@ def main():
         )
         ptvsd.wait_for_attach()
 
+    if args.local_rank == -1 and "LOCAL_RANK" in os.environ:
+        # launched by torchrun, which only passes the rank in the environment
+        args.local_rank = int(os.environ["LOCAL_RANK"])
+    if args.num_processes > 1 and args.local_rank == -1:
+        spawn_cpu_processes(args)
+        return {}
+    return run(args)
+
+
+def spawn_cpu_processes(args):
+    """Runs `run` in `args.num_processes` local CPU processes, which train
+    on the gloo backend."""
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    os.environ["WORLD_SIZE"] = str(args.num_processes)
+    os.environ["LOCAL_WORLD_SIZE"] = str(args.num_processes)
+    args.no_cuda = True
+    torch.multiprocessing.spawn(
+        _run_cpu_process, args=(args,), nprocs=args.num_processes
+    )
+
+
+def _run_cpu_process(local_rank, args):
+    os.environ["RANK"] = os.environ["LOCAL_RANK"] = str(local_rank)
+    args.local_rank = local_rank
+    run(args)
+
+
+def run(args):
     # Setup CUDA, GPU & distributed training
-    if args.local_rank == -1 or args.no_cuda:
+    if args.local_rank == -1:
         device = torch.device(
             "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu"
         )
-        args.n_gpu = 0 if args.no_cuda else torch.cuda.device_count()
+        args.n_gpu = 0 if device.type == "cpu" else torch.cuda.device_count()
+    elif args.no_cuda or not torch.cuda.is_available():
+        # CPU data parallel: one process per rank, sharing the cores
+        device = torch.device("cpu")
+        torch.distributed.init_process_group(backend="gloo")
+        args.n_gpu = 0
     else:  # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.cuda.set_device(args.local_rank)
         device = torch.device("cuda", args.local_rank)
         torch.distributed.init_process_group(backend="nccl")
         args.n_gpu = 1
     args.device = device
+    if device.type == "cpu" and (
+        args.threads_per_rank or args.local_rank != -1
+    ):
+        local_world_size = int(
+            os.environ.get("LOCAL_WORLD_SIZE", args.num_processes or 1)
+        )
+        torch.set_num_threads(
+            args.threads_per_rank
+            or max(1, (os.cpu_count() or 1) // local_world_size)
+        )
 
     # Setup logging
     logging.basicConfig(
@@ -988,13 +2282,24 @@ def main():
         level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN,
     )
     logger.warning(
-        "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
+        "Process rank: %s, device: %s, n_gpu: %s, threads: %s, distributed training: %s, 16-bits training: %s",
         args.local_rank,
         device,
         args.n_gpu,
+        torch.get_num_threads(),
         bool(args.local_rank != -1),
-        args.fp16,
+        "fp16" if args.fp16 else "bf16" if args.bf16 else False,
     )
+    if args.fp16 and args.bf16:
+        raise ValueError("--fp16 and --bf16 are exclusive")
+    if args.save_best_metric and args.local_rank != -1:
+        raise ValueError(
+            "--save_best_metric evaluates during training, which needs a single process"
+        )
+    if args.save_best_metric and not args.do_eval:
+        raise ValueError("--save_best_metric evaluates on the dev set, add --do_eval")
+    if args.fp16 and device.type != "cuda":
+        raise ValueError("--fp16 needs CUDA, use --bf16 on CPU")
 
     # Set seed
     set_seed(args)
@@ -1015,6 +2320,11 @@ def main():
 
     args.model_type = args.model_type.lower()
     config_class, model_class, tokenizer_class = MODEL_CLASSES[args.model_type]
+    if (
+        not args.no_fast_tokenizer
+        and FAST_TOKENIZER_CLASSES.get(args.model_type) is not None
+    ):
+        tokenizer_class = FAST_TOKENIZER_CLASSES[args.model_type]
     config = config_class.from_pretrained(
         args.config_name if args.config_name else args.model_name_or_path,
         finetuning_task=args.task_name,
@@ -1022,6 +2332,22 @@ def main():
     )
     config.num_labels_a = num_labels_a
     config.num_labels_b = num_labels_b
+    if args.early_exit_layers is not None:
+        config.early_exit_layers = args.early_exit_layers
+    if args.language_heads and not getattr(config, "head_languages", None):
+        config.head_languages = args.folder_list or processor.folder_list
+    if args.lora_rank > 0 and not getattr(config, "lora_rank", 0):
+        config.lora_rank = args.lora_rank
+        config.lora_alpha = args.lora_alpha
+        config.lora_dropout = args.lora_dropout
+        config.lora_target_modules = args.lora_target_modules
+        # adapters are loaded on top of the base model from wherever they
+        # are, a local base model is referred to by its absolute path
+        config.lora_base_model = (
+            os.path.abspath(args.model_name_or_path)
+            if os.path.isdir(args.model_name_or_path)
+            else args.model_name_or_path
+        )
     tokenizer = tokenizer_class.from_pretrained(
         args.tokenizer_name
         if args.tokenizer_name
@@ -1036,6 +2362,35 @@ def main():
         cache_dir=args.cache_dir if args.cache_dir else None,
     )
 
+    if (
+        args.do_train
+        and 0 < args.student_num_hidden_layers < config.num_hidden_layers
+    ):
+        model = init_student(model, args.student_num_hidden_layers)
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+        if model.lora_rank > 0:
+            # the frozen embeddings output no gradient, which the checkpointed
+            # layers need to backpropagate into their adapters
+            model.enable_input_require_grads()
+    if model.lora_rank > 0:
+        logger.info(
+            "Low-rank adaptation: training %d of %d parameters",
+            sum(p.numel() for p in model.parameters() if p.requires_grad),
+            sum(p.numel() for p in model.parameters()),
+        )
+    teacher = None
+    if (
+        args.do_train
+        and args.teacher_model_name_or_path
+        and not args.use_cached_logits
+    ):
+        teacher = MultiHeadClassification.from_pretrained(
+            args.teacher_model_name_or_path,
+            cache_dir=args.cache_dir if args.cache_dir else None,
+        )
+        teacher.to(args.device)
+
     if args.local_rank == 0:
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
@@ -1043,12 +2398,37 @@ def main():
 
     logger.info("Training/evaluation parameters %s", args)
 
+    if args.do_cache_logits and args.local_rank in [-1, 0]:
+        for mode in args.cache_logits_splits:
+            cache_logits(
+                args,
+                model,
+                tokenizer,
+                mode,
+                get_logits_dir(args, args.model_name_or_path),
+            )
+
     # Training
     if args.do_train:
         train_dataset = load_and_cache_examples(
             args, args.task_name, tokenizer, "train"
         )
-        global_step, tr_loss = train(args, train_dataset, model, tokenizer)
+        teacher_logits = None
+        if args.teacher_model_name_or_path and args.use_cached_logits:
+            teacher_logits = LogitsStore(
+                os.path.join(
+                    get_logits_dir(args, args.teacher_model_name_or_path),
+                    "train",
+                )
+            ).aligned(train_dataset)
+        global_step, tr_loss = train(
+            args,
+            train_dataset,
+            model,
+            tokenizer,
+            teacher=teacher,
+            teacher_logits=teacher_logits,
+        )
         logger.info(
             " global_step = %s, average loss = %s", global_step, tr_loss
         )
@@ -1092,11 +2472,23 @@ def main():
                     glob.glob(
                         args.output_dir + "/**/" + WEIGHTS_NAME, recursive=True
                     )
+                    + glob.glob(
+                        args.output_dir + "/**/" + ADAPTER_WEIGHTS_NAME,
+                        recursive=True,
+                    )
                 )
             )
             logging.getLogger("transformers.modeling_utils").setLevel(
                 logging.WARN
             )  # Reduce logging
+        if args.ensemble:
+            results = evaluate_ensemble(
+                args,
+                args.ensemble_checkpoints or checkpoints,
+                tokenizer,
+                label_list,
+            )
+            checkpoints = []  # evaluated together above
         logger.info("Evaluate the following checkpoints: %s", checkpoints)
         for checkpoint in checkpoints:
             global_step = (
@@ -1109,9 +2501,27 @@ def main():
             )
 
             model = MultiHeadClassification.from_pretrained(checkpoint)
+            model.early_exit_threshold = args.early_exit_threshold
+            if args.quantize:
+                # dynamically quantized kernels only exist for CPU
+                args.device = torch.device("cpu")
+                args.n_gpu = 0
+                model = quantize_model(model)
+                quantized_dir = os.path.join(checkpoint, "quantized")
+                logger.info("Saving quantized model to %s", quantized_dir)
+                save_quantized_model(model, quantized_dir)
             model.to(args.device)
             try:
-                result = evaluate(args, model, tokenizer,label_list, prefix=prefix)
+                result = evaluate(
+                    args,
+                    model,
+                    tokenizer,
+                    label_list,
+                    prefix=prefix,
+                    logits_dir=get_logits_dir(args, checkpoint)
+                    if args.use_cached_logits
+                    else None,
+                )
                 if args.do_eval:
                     result = dict(
                         (k + "_{}".format(global_step), v)
@@ -1121,6 +2531,8 @@ def main():
             except Exception as ex:
                 print(ex, "main-evaluate")
                 traceback.print_stack()
+    if args.local_rank != -1:
+        torch.distributed.destroy_process_group()
     logger.info("trained")
     return results
 
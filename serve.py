@@ -0,0 +1,433 @@
+"""HTTP inference server for a trained MultiHeadClassification model.
+
+Concurrent single-comment requests are coalesced into micro-batches: a batch
+is scored as soon as it holds --max_batch_size comments or its oldest
+comment has waited --max_latency_ms, and both heads come out of one forward
+pass. A model trained with --language_heads serves every language from one
+encoder; requests give their ``language`` and mixed-language batches are
+still scored in one pass.
+
+    python serve.py serve --model_name_or_path trained-model --do_lower_case
+    curl -d '{"text": "Nice video...."}' localhost:8000/predict
+    curl -d '{"text": "Nice video....", "language": "hin"}' \
+        localhost:8000/predict
+    curl localhost:8000/metrics
+
+    python serve.py loadtest --data eng/trac2_eng_dev.csv --concurrency 32
+    python serve.py loadtest --data eng/trac2_eng_dev.csv \
+        hin/trac2_hin_dev.csv --languages eng hin
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import random
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+import torch
+
+from predict import load_model, predict_chunk
+from trac_dataloader import DynamicPaddingCollator, InputExample, processors
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher(object):
+    """Queues comments and scores them in batches from a worker thread."""
+
+    def __init__(self, args, model, tokenizer, label_list):
+        self.args = args
+        self.model = model
+        self.tokenizer = tokenizer
+        self.label_list = label_list
+        self.collator = DynamicPaddingCollator(
+            pad_token_id=tokenizer.pad_token_id
+        )
+        self.queue = asyncio.Queue()
+        self.latencies = collections.deque(maxlen=args.metrics_window)
+        self.batch_sizes = collections.deque(maxlen=args.metrics_window)
+        self.num_requests = 0
+
+    def check_language(self, language):
+        """Raises ValueError if the model has no heads for `language`."""
+        if getattr(self.model, "head_languages", None):
+            self.model.language_ids([language])
+
+    async def predict(self, text, language=None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, language, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        max_latency = self.args.max_latency_ms / 1000
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][3] + max_latency
+            while len(batch) < self.args.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self.queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            examples = [
+                InputExample(guid=i, text=text, language=language)
+                for i, (text, language, _, _) in enumerate(batch)
+            ]
+            try:
+                probs_a, probs_b = await loop.run_in_executor(
+                    None,
+                    predict_chunk,
+                    self.args,
+                    self.model,
+                    self.tokenizer,
+                    self.collator,
+                    self.label_list,
+                    examples,
+                )
+            except Exception as ex:
+                for _, _, future, _ in batch:
+                    if not future.done():  # done if the client went away
+                        future.set_exception(ex)
+                continue
+            now = time.perf_counter()
+            self.batch_sizes.append(len(batch))
+            for (_, _, future, start), prob_a, prob_b in zip(
+                batch, probs_a, probs_b
+            ):
+                self.latencies.append(now - start)
+                self.num_requests += 1
+                if not future.done():
+                    future.set_result(self._response(prob_a, prob_b))
+
+    def _response(self, prob_a, prob_b):
+        response = {}
+        for task, probs in (("a", prob_a), ("b", prob_b)):
+            labels = self.label_list[task]
+            response["label_" + task] = labels[int(probs.argmax())]
+            response["probs_" + task] = {
+                label: float(p) for label, p in zip(labels, probs)
+            }
+        return response
+
+    def metrics(self):
+        metrics = {"requests": self.num_requests, "batches": 0}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            metrics.update(
+                {
+                    "batches": len(batch_sizes),
+                    "latency_ms": {
+                        "p50": float(np.percentile(latencies, 50)),
+                        "p99": float(np.percentile(latencies, 99)),
+                        "max": float(latencies.max()),
+                    },
+                    "batch_size": {
+                        "mean": float(batch_sizes.mean()),
+                        "p50": float(np.percentile(batch_sizes, 50)),
+                        "max": int(batch_sizes.max()),
+                    },
+                }
+            )
+        return metrics
+
+
+async def read_request(reader):
+    """Reads one HTTP/1.1 request, returns None on a closed connection."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(
+        (
+            "HTTP/1.1 {}\r\nContent-Type: application/json\r\n"
+            "Content-Length: {}\r\nConnection: {}\r\n\r\n"
+        )
+        .format(status, len(body), "keep-alive" if keep_alive else "close")
+        .encode("latin-1")
+        + body
+    )
+
+
+async def handle_connection(batcher, reader, writer):
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                break
+            method, path, headers, body = request
+            keep_alive = headers.get("connection", "").lower() != "close"
+            if method == "POST" and path == "/predict":
+                error = None
+                try:
+                    payload = json.loads(body)
+                    text = payload["text"]
+                    language = payload.get("language", batcher.args.language)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    error = 'expected a JSON body {"text": ...}'
+                else:
+                    try:
+                        batcher.check_language(language)
+                    except ValueError as ex:
+                        error = str(ex)
+                if error is not None:
+                    write_response(
+                        writer, "400 Bad Request", {"error": error}, keep_alive
+                    )
+                else:
+                    try:
+                        response = await batcher.predict(str(text), language)
+                    except Exception as ex:
+                        logger.exception("Scoring failed")
+                        write_response(
+                            writer,
+                            "500 Internal Server Error",
+                            {"error": str(ex)},
+                            keep_alive,
+                        )
+                    else:
+                        write_response(writer, "200 OK", response, keep_alive)
+            elif method == "GET" and path == "/metrics":
+                write_response(writer, "200 OK", batcher.metrics(), keep_alive)
+            elif method == "GET" and path == "/health":
+                write_response(writer, "200 OK", {"status": "ok"}, keep_alive)
+            else:
+                write_response(
+                    writer, "404 Not Found", {"error": path}, keep_alive
+                )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    label_list = processors[args.task_name]().get_labels()
+    model, tokenizer = load_model(args)
+    args.batch_size = args.max_batch_size
+    batcher = MicroBatcher(args, model, tokenizer, label_list)
+    batcher_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(batcher, reader, writer),
+        args.host,
+        args.port,
+    )
+    logger.info("Serving on http://%s:%d", args.host, args.port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher_task.cancel()
+
+
+async def _request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(
+        "{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        "Content-Length: {}\r\n\r\n".format(method, path, len(body)).encode(
+            "latin-1"
+        )
+        + body
+    )
+    await writer.drain()
+    status = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return int(status.split()[1]), json.loads(body)
+
+
+async def load_test(args):
+    """Sends the --data comments from --concurrency keep-alive connections
+    and reports client-side latency, throughput and the server metrics."""
+    url = urlsplit(args.url)
+    payloads = []
+    languages = args.languages or [None] * len(args.data)
+    for data, language in zip(args.data, languages):
+        for text in pd.read_csv(data)["Text"].astype(str).tolist():
+            payload = {"text": text}
+            if language is not None:
+                payload["language"] = language
+            payloads.append(payload)
+    # interleaved, so batches mix the languages
+    random.Random(0).shuffle(payloads)
+    payloads = (payloads * (args.requests // len(payloads) + 1))[
+        : args.requests
+    ]
+    queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+    latencies, errors = [], 0
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(url.hostname, url.port)
+        try:
+            while not queue.empty():
+                payload = queue.get_nowait()
+                start = time.perf_counter()
+                status, _ = await _request(
+                    reader, writer, "POST", "/predict", payload
+                )
+                latencies.append(time.perf_counter() - start)
+                errors += status != 200
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(url.hostname, url.port)
+    _, server_metrics = await _request(reader, writer, "GET", "/metrics")
+    writer.close()
+    latencies = np.array(latencies) * 1000
+    report = {
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": args.concurrency,
+        "requests_per_s": len(latencies) / elapsed,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)),
+        },
+        "server": server_metrics,
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the server.")
+    serve_parser.add_argument(
+        "--model_name_or_path",
+        default=None,
+        type=str,
+        required=True,
+        help="Directory of a model trained with run_classification.py",
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1", type=str)
+    serve_parser.add_argument("--port", default=8000, type=int)
+    serve_parser.add_argument(
+        "--max_batch_size",
+        default=32,
+        type=int,
+        help="Largest micro-batch scored in one forward pass",
+    )
+    serve_parser.add_argument(
+        "--max_latency_ms",
+        default=10.0,
+        type=float,
+        help="How long the first comment of a batch waits for more",
+    )
+    serve_parser.add_argument(
+        "--metrics_window",
+        default=10000,
+        type=int,
+        help="Number of recent requests and batches /metrics reports on",
+    )
+    serve_parser.add_argument("--model_type", default="bert", type=str)
+    serve_parser.add_argument("--task_name", default="trac", type=str)
+    serve_parser.add_argument("--tokenizer_name", default="", type=str)
+    serve_parser.add_argument("--do_lower_case", action="store_true")
+    serve_parser.add_argument("--no_fast_tokenizer", action="store_true")
+    serve_parser.add_argument("--max_seq_length", default=128, type=int)
+    serve_parser.add_argument("--no_cuda", action="store_true")
+    serve_parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Run an int8 dynamically quantized model on CPU",
+    )
+    serve_parser.add_argument(
+        "--early_exit_threshold",
+        default=0.0,
+        type=float,
+        help="Stop at the first early exit where both heads reach this probability",
+    )
+    serve_parser.add_argument(
+        "--language",
+        default=None,
+        type=str,
+        help="Language of requests without one, for a model trained with --language_heads",
+    )
+    serve_parser.add_argument(
+        "--backend",
+        default="pytorch",
+        choices=["pytorch", "onnx", "torchscript"],
+        help="Run the model saved by `export.py onnx` or `export.py torchscript`",
+    )
+
+    load_test_parser = subparsers.add_parser(
+        "loadtest", help="Load-test a running server."
+    )
+    load_test_parser.add_argument(
+        "--url", default="http://127.0.0.1:8000", type=str
+    )
+    load_test_parser.add_argument(
+        "--data",
+        default=["eng/trac2_eng_dev.csv"],
+        type=str,
+        nargs="+",
+        help="CSVs whose Text column is sent, repeated as needed",
+    )
+    load_test_parser.add_argument(
+        "--languages",
+        default=None,
+        type=str,
+        nargs="*",
+        help="Language of every --data file, sent with its comments",
+    )
+    load_test_parser.add_argument("--requests", default=2000, type=int)
+    load_test_parser.add_argument("--concurrency", default=32, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    if args.command == "serve":
+        args.device = torch.device(
+            "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu"
+        )
+        asyncio.run(serve(args))
+    else:
+        asyncio.run(load_test(args))
+
+
+if __name__ == "__main__":
+    main()
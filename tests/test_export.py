@@ -0,0 +1,68 @@
+import argparse
+import os
+
+import pytest
+import torch
+from transformers import BertConfig
+
+from export import (
+    ONNX_NAME,
+    _example_inputs,
+    export_onnx,
+    export_torchscript,
+    load_backend,
+    onnx_opset,
+)
+from run_classification import MultiHeadClassification
+
+pytest.importorskip("onnxruntime")
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=1000,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+    )
+    config.num_labels_a = 3
+    config.num_labels_b = 2
+    model_dir = str(tmp_path_factory.mktemp("model"))
+    MultiHeadClassification(config).save_pretrained(model_dir)
+    return model_dir
+
+
+@pytest.mark.parametrize("backend", ["onnx", "torchscript"])
+def test_export_matches_eager_model(model_dir, backend):
+    args = argparse.Namespace(
+        model_name_or_path=model_dir, output_file="", opset=14
+    )
+    if backend == "onnx":
+        export_onnx(args)
+        path = os.path.join(model_dir, ONNX_NAME)
+        assert onnx_opset(path) == 14
+        assert os.listdir(os.path.dirname(path)) == ["model.onnx"]
+    else:
+        export_torchscript(args)
+    eager = load_backend("pytorch", model_dir).eval()
+    exported = load_backend(backend, model_dir)
+    # other shapes than the traced ones, with padding
+    for batch_size, sequence_length in ((1, 7), (5, 33)):
+        input_ids, attention_mask, token_type_ids = _example_inputs(
+            batch_size, sequence_length
+        )
+        attention_mask[0, sequence_length // 2 :] = 0
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": token_type_ids,
+        }
+        with torch.no_grad():
+            expected = eager(**inputs)[1:3]
+            outputs = exported(**inputs)[1:3]
+        for want, got in zip(expected, outputs):
+            assert got.shape == want.shape
+            torch.testing.assert_close(got, want, atol=1e-4, rtol=1e-4)
@@ -0,0 +1,63 @@
+import numpy as np
+from torch.utils.data import BatchSampler
+from torch.utils.data.distributed import DistributedSampler
+
+from trac_dataloader import (
+    LengthGroupedSampler,
+    SkipBatchSampler,
+    TokenBudgetBatchSampler,
+)
+
+
+def _epoch_batches(sampler, epoch):
+    sampler.set_epoch(epoch)
+    return [list(batch) for batch in sampler]
+
+
+def test_skip_batch_sampler_reshuffles_every_epoch():
+    lengths = np.arange(1, 201) % 37 + 1
+    for batch_sampler in (
+        BatchSampler(
+            DistributedSampler(range(200), num_replicas=1, rank=0, seed=42),
+            4,
+            False,
+        ),
+        BatchSampler(
+            LengthGroupedSampler(
+                lengths, 4, num_replicas=1, rank=0, seed=42, mega_batch_mult=2
+            ),
+            4,
+            False,
+        ),
+        TokenBudgetBatchSampler(
+            lengths, 64, num_replicas=1, rank=0, seed=42
+        ),
+    ):
+        sampler = SkipBatchSampler(batch_sampler)
+        assert _epoch_batches(sampler, 0) != _epoch_batches(sampler, 1)
+        assert _epoch_batches(sampler, 0) == _epoch_batches(sampler, 0)
+
+
+def test_skip_batch_sampler_skips_batches():
+    batch_sampler = BatchSampler(
+        DistributedSampler(range(20), num_replicas=1, rank=0, seed=42),
+        4,
+        False,
+    )
+    sampler = SkipBatchSampler(batch_sampler, skip=2)
+    full = _epoch_batches(SkipBatchSampler(batch_sampler), 1)
+    assert len(sampler) == 3
+    assert _epoch_batches(sampler, 1) == full[2:]
+
+
+def test_token_budget_pads_every_replica():
+    lengths = np.array([10, 10, 10])
+    replicas = [
+        list(TokenBudgetBatchSampler(lengths, 10, num_replicas=4, rank=rank))
+        for rank in range(4)
+    ]
+    assert [len(batches) for batches in replicas] == [1, 1, 1, 1]
+    padded = [batches[0] for batches in replicas]
+    assert sorted(i for batch in padded[:3] for i in batch) == [0, 1, 2]
+    (batch,) = TokenBudgetBatchSampler(lengths, 1000, num_replicas=4, rank=3)
+    assert sorted(batch) == [0, 1, 2]
@@ -18,17 +18,41 @@
 
 from __future__ import absolute_import, division, print_function
 
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import shutil
+import threading
+import time
 from dataclasses import dataclass
-from typing import List, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Union
 
+import numpy as np
 import pandas as pd
+import torch
 from scipy.stats import pearsonr, spearmanr
 from sklearn.metrics import f1_score
+from torch.utils.data import ConcatDataset, Dataset, Sampler
+
+try:
+    from transformers import PreTrainedTokenizerFast
+except ImportError:
+    PreTrainedTokenizerFast = None
 
 logger = logging.getLogger(__name__)
 
+# InputExample field -> column of the trac2_{lang}_{split}.csv files
+CSV_COLUMNS = {
+    "guid": "ID",
+    "text": "Text",
+    "label_a": "Sub-task A",
+    "label_b": "Sub-task B",
+}
+
 
 @dataclass
 class InputExample(object):
@@ -60,6 +84,7 @@ class InputFeatures(object):
     segment_ids: List[int]
     label_a: int
     label_b: int
+    guid: Optional[Union[str, int]] = None
 
 
 class TracProcessor(object):
@@ -82,30 +107,105 @@ class TracProcessor(object):
     """def get_label_from_name(self, name):
         return label_dict[id]"""
 
-    def get_examples(
-        self, data_dir, set_type, folder_list=Optional[List[str]]
-    ):
-        """Creates examples for the training and dev sets from labelled folder."""
+    def get_dataset_file(self, data_dir: str, folder: str, set_type: str):
+        return f"{data_dir}/{folder}/trac2_{folder}_{set_type}.csv"
+
+    def iter_columns(
+        self,
+        data_dir: str,
+        set_type: str,
+        folder_list: Optional[List[str]] = None,
+        chunksize: Optional[int] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Yields the labelled folders as column batches.
 
-        examples = []
+        Every batch is a dict with the ``guid``, ``text``, ``label_a`` and
+        ``label_b`` columns as numpy arrays plus the ``language`` of the
+        folder they came from. Missing label columns (test sets) are filled
+        with ``None``.
+
+        Keyword Arguments:
+            folder_list {Optional[List[str]]} -- folders to read
+                (default: {self.folder_list})
+            chunksize {Optional[int]} -- rows per batch, a whole file per
+                batch if not set (default: {None})
+        """
         if not folder_list:
             folder_list = self.folder_list
         for folder in folder_list:
-            dataset_file = f"{data_dir}/{folder}/trac2_{folder}_{set_type}.csv"
+            dataset_file = self.get_dataset_file(data_dir, folder, set_type)
             if not os.path.exists(dataset_file):
                 print(dataset_file, "doesn't exist")
                 continue
-            df = pd.read_csv(dataset_file)
-            for _, row in df.iterrows():
-                example = InputExample(
-                    guid=row["ID"],
-                    text=row["Text"],
-                    label_a=row.get("Sub-task A"),
-                    label_b=row.get("Sub-task B"),
-                    language=folder,
+            reader = pd.read_csv(
+                dataset_file,
+                usecols=lambda column: column in CSV_COLUMNS.values(),
+                chunksize=chunksize,
+            )
+            for df in reader if chunksize else (reader,):
+                columns = {"language": folder}
+                for key, column in CSV_COLUMNS.items():
+                    if column in df:
+                        columns[key] = df[column].to_numpy()
+                    else:
+                        columns[key] = np.full(len(df), None, dtype=object)
+                yield columns
+
+    def iter_examples(
+        self,
+        data_dir: str,
+        set_type: str,
+        folder_list: Optional[List[str]] = None,
+        chunksize: Optional[int] = None,
+    ) -> Iterator[InputExample]:
+        """Lazily creates examples from the column batches of `iter_columns`."""
+        for columns in self.iter_columns(
+            data_dir, set_type, folder_list, chunksize
+        ):
+            language = columns["language"]
+            for guid, text, label_a, label_b in zip(
+                columns["guid"],
+                columns["text"],
+                columns["label_a"],
+                columns["label_b"],
+            ):
+                yield InputExample(
+                    guid=guid,
+                    text=text,
+                    label_a=label_a,
+                    label_b=label_b,
+                    language=language,
                 )
-                examples.append(example)
-        return examples
+
+    def get_examples(
+        self,
+        data_dir: str,
+        set_type: str,
+        folder_list: Optional[List[str]] = None,
+    ) -> List[InputExample]:
+        """Creates examples for the training and dev sets from labelled folder."""
+        return list(self.iter_examples(data_dir, set_type, folder_list))
+
+
+def _tokenize_batch(tokenizer, texts):
+    """Tokenizes `texts` into token ids without special tokens.
+
+    Fast (Rust-backed) tokenizers encode the whole batch in one call,
+    python tokenizers fall back to one `tokenize` pass per text.
+    """
+    if PreTrainedTokenizerFast is not None and isinstance(
+        tokenizer, PreTrainedTokenizerFast
+    ):
+        return tokenizer.batch_encode_plus(
+            list(texts),
+            add_special_tokens=False,
+            return_token_type_ids=False,
+            return_attention_mask=False,
+        )["input_ids"]
+    return [
+        tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+        for text in texts
+    ]
 
 
 def convert_examples_to_features(
@@ -123,121 +223,849 @@ def convert_examples_to_features(
     cls_token_segment_id=1,
     pad_token_segment_id=0,
     mask_padding_with_zero=True,
+    batch_size=1024,
+    pad_to_max_length=True,
 ):
     """ Loads a data file into a list of `InputBatch`s
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `batch_size` examples are tokenized per tokenizer call
+        `pad_to_max_length` False leaves the padding to the batch collator
+        (see `DynamicPaddingCollator`)
     """
     label_maps = dict()
     for key, labels in label_list.items():
         label_maps[key] = {label: i for i, label in enumerate(labels)}
 
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-        tokens = tokenizer.tokenize(example.text)
-        tokens = tokens[: (max_seq_length - 2)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids:   0   0   0   0  0     0   0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambiguously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = tokens + [sep_token]
-        segment_ids = [sequence_segment_id] * len(tokens)
-
-        if cls_token_at_end:
-            tokens = tokens + [cls_token]
-            segment_ids = segment_ids + [cls_token_segment_id]
-        else:
-            tokens = [cls_token] + tokens
-            segment_ids = [cls_token_segment_id] + segment_ids
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids(
+        [cls_token, sep_token]
+    )
+    num_special_tokens = len(tokenizer.build_inputs_with_special_tokens([]))
 
-        # padding_length = max_seq_length - len(input_ids)
-        sequence_a_dict = tokenizer.encode_plus(
-            tokens, max_length=max_seq_length, pad_to_max_length=True
+    features = []
+    for start in range(0, len(examples), batch_size):
+        logger.info("Writing example %d of %d" % (start, len(examples)))
+        batch = examples[start : start + batch_size]
+        batch_token_ids = _tokenize_batch(
+            tokenizer, [example.text for example in batch]
         )
-        input_ids = sequence_a_dict["input_ids"]
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        attention_mask = sequence_a_dict["attention_mask"]
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(segment_ids)
-        if pad_on_left:
-            segment_ids = (
-                [pad_token_segment_id] * padding_length
-            ) + segment_ids
-        else:
-            segment_ids = segment_ids + (
-                [pad_token_segment_id] * padding_length
-            )
+        for example, token_ids in zip(batch, batch_token_ids):
+            token_ids = token_ids[: (max_seq_length - 2)]
 
-        assert len(input_ids) == max_seq_length
-        assert len(attention_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        if output_mode == "classification":
-            label_a = label_maps["a"].get(example.label_a)
-            label_b = label_maps["b"].get(example.label_b)
-            if label_a is None:
-                label_a = 0
-            if label_b is None:
-                label_b = 0
-        elif output_mode == "regression":
-            label_id = float(example.label)
-        else:
-            raise KeyError(output_mode)
+            # The convention in BERT is:
+            # (a) For sequence pairs:
+            #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+            #  type_ids:   0   0  0    0    0     0       0   0   1  1  1  1   1   1
+            # (b) For single sequences:
+            #  tokens:   [CLS] the dog is hairy . [SEP]
+            #  type_ids:   0   0   0   0  0     0   0
+            #
+            # Where "type_ids" are used to indicate whether this is the first
+            # sequence or the second sequence. The embedding vectors for `type=0` and
+            # `type=1` were learned during pre-training and are added to the wordpiece
+            # embedding vector (and position vector). This is not *strictly* necessary
+            # since the [SEP] token unambiguously separates the sequences, but it makes
+            # it easier for the model to learn the concept of sequences.
+            #
+            # For classification tasks, the first vector (corresponding to [CLS]) is
+            # used as as the "sentence vector". Note that this only makes sense because
+            # the entire model is fine-tuned.
+            token_ids = token_ids + [sep_token_id]
+            segment_ids = [sequence_segment_id] * len(token_ids)
 
-        if ex_index < 0:
-            logger.info("*** Example ***")
-            logger.info("guid: {}".format(example.guid))
-            logger.info(
-                "tokens: {}".format(" ".join([str(x) for x in tokens]))
+            if cls_token_at_end:
+                token_ids = token_ids + [cls_token_id]
+                segment_ids = segment_ids + [cls_token_segment_id]
+            else:
+                token_ids = [cls_token_id] + token_ids
+                segment_ids = [cls_token_segment_id] + segment_ids
+
+            # The tokens above used to go through `encode_plus`, which adds
+            # the special tokens once more and truncates from the end. The
+            # released models are trained on that layout, so keep it.
+            input_ids = tokenizer.build_inputs_with_special_tokens(
+                token_ids[: (max_seq_length - num_special_tokens)]
             )
-            logger.info(
-                "input_ids: {}".format(" ".join([str(x) for x in input_ids]))
+
+            # The mask has 1 for real tokens and 0 for padding tokens. Only real
+            # tokens are attended to.
+            attention_mask = [1 if mask_padding_with_zero else 0] * len(
+                input_ids
             )
-            logger.info(
-                "input_mask: {}".format(
-                    " ".join([str(x) for x in attention_mask])
+
+            # Zero-pad up to the sequence length.
+            padded_length = (
+                max_seq_length if pad_to_max_length else len(input_ids)
+            )
+            padding_length = padded_length - len(input_ids)
+            input_padding = [pad_token] * padding_length
+            mask_padding = [
+                0 if mask_padding_with_zero else 1
+            ] * padding_length
+            if tokenizer.padding_side == "left":
+                input_ids = input_padding + input_ids
+                attention_mask = mask_padding + attention_mask
+            else:
+                input_ids = input_ids + input_padding
+                attention_mask = attention_mask + mask_padding
+
+            padding_length = padded_length - len(segment_ids)
+            if pad_on_left:
+                segment_ids = (
+                    [pad_token_segment_id] * padding_length
+                ) + segment_ids
+            else:
+                segment_ids = segment_ids + (
+                    [pad_token_segment_id] * padding_length
+                )
+
+            assert len(input_ids) == padded_length
+            assert len(attention_mask) == padded_length
+            assert len(segment_ids) == padded_length
+
+            if output_mode == "classification":
+                label_a = label_maps["a"].get(example.label_a)
+                label_b = label_maps["b"].get(example.label_b)
+                if label_a is None:
+                    label_a = 0
+                if label_b is None:
+                    label_b = 0
+            elif output_mode == "regression":
+                label_a = float(example.label_a)
+                label_b = float(example.label_b)
+            else:
+                raise KeyError(output_mode)
+
+            features.append(
+                InputFeatures(
+                    input_ids=input_ids,
+                    input_mask=attention_mask,
+                    segment_ids=segment_ids,
+                    label_a=label_a,
+                    label_b=label_b,
+                    guid=example.guid,
                 )
             )
-            logger.info(
-                "segment_ids: {}".format(
-                    " ".join([str(x) for x in segment_ids])
+    return features
+
+
+# bump when the layout of converted features or of the cache changes
+FEATURE_CACHE_VERSION = 4
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha1 of the contents of `path`."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """sha1 of everything about `tokenizer` that changes its output."""
+    vocab = (
+        tokenizer.get_vocab()
+        if hasattr(tokenizer, "get_vocab")
+        else tokenizer.vocab
+    )
+    state = {
+        "class": type(tokenizer).__name__,
+        "vocab": sorted(vocab.items()),
+        "special_tokens": tokenizer.special_tokens_map,
+        "do_lower_case": tokenizer.init_kwargs.get("do_lower_case"),
+        "padding_side": tokenizer.padding_side,
+    }
+    return hashlib.sha1(
+        json.dumps(state, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _sha1_json(state):
+    return hashlib.sha1(
+        json.dumps(state, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def feature_options_key(tokenizer_hash, options):
+    """Key of everything but the data the features depend on.
+
+    Arguments:
+        tokenizer_hash {str} -- `tokenizer_fingerprint` of the tokenizer
+        options {dict} -- JSON-serializable preprocessing options
+            (task, split, max_seq_length, labels, padding...)
+    """
+    return _sha1_json(
+        {
+            "version": FEATURE_CACHE_VERSION,
+            "tokenizer": tokenizer_hash,
+            "options": options,
+        }
+    )
+
+
+def feature_cache_key(data_hash, options_key):
+    """Content address of the features of one (language, split) unit:
+    its CSV `file_digest` and its `feature_options_key`."""
+    return _sha1_json({"data": data_hash, "options": options_key})
+
+
+def read_feature_cache_meta(cache_dir):
+    with open(os.path.join(cache_dir, "meta.json")) as f:
+        return json.load(f)
+
+
+def invalidate_feature_unit(cache_dir, current_dir):
+    """Deletes the entries of `cache_dir` that hold an older version of the
+    (language, split) unit cached in `current_dir`: same language, split
+    and options but different CSV contents.
+    """
+    current = read_feature_cache_meta(current_dir)
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if ".tmp-" in name or os.path.samefile(path, current_dir):
+            continue
+        try:
+            meta = read_feature_cache_meta(path)
+        except (OSError, ValueError):
+            continue
+        if all(
+            meta.get(key) == current.get(key)
+            for key in ("language", "mode", "options_key")
+        ):
+            logger.info("Removing outdated cached features %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def evict_feature_cache(cache_dir, size_limit, keep=()):
+    """Deletes least recently used entries of `cache_dir` until it is
+    smaller than `size_limit` bytes. Entries in `keep` are never deleted.
+    """
+    if size_limit <= 0 or not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        meta_file = os.path.join(path, "meta.json")
+        if os.path.isfile(meta_file):
+            entries.append(
+                (os.path.getmtime(meta_file), _dir_size(path), path)
+            )
+    total_size = sum(size for _, size, _ in entries)
+    keep = {os.path.abspath(path) for path in keep}
+    for _, size, path in sorted(entries):
+        if total_size <= size_limit:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        logger.info("Evicting cached features %s", path)
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+
+# tokenizer and options of the featurization pool worker processes
+_worker_state = {}
+
+
+def _init_featurization_worker(tokenizer, kwargs):
+    _worker_state["tokenizer"] = tokenizer
+    _worker_state["kwargs"] = kwargs
+
+
+def _convert_shard(examples):
+    return convert_examples_to_features(
+        examples, _worker_state["tokenizer"], **_worker_state["kwargs"]
+    )
+
+
+def convert_examples_to_features_parallel(
+    examples, tokenizer, num_workers=1, shards_per_worker=4, **kwargs
+):
+    """Runs `convert_examples_to_features` over a pool of `num_workers`
+    processes.
+
+    The examples are split into contiguous shards and the featurized shards
+    are concatenated back in the original example order, so predictions
+    still line up with the rows of the input CSVs.
+    """
+    if num_workers <= 1 or len(examples) < 2 * num_workers:
+        return convert_examples_to_features(examples, tokenizer, **kwargs)
+    shard_size = -(-len(examples) // (num_workers * shards_per_worker))
+    shards = [
+        examples[start : start + shard_size]
+        for start in range(0, len(examples), shard_size)
+    ]
+    logger.info(
+        "Featurizing %d examples in %d shards on %d processes",
+        len(examples),
+        len(shards),
+        num_workers,
+    )
+    # the processes already split the work, keep fast tokenizers from also
+    # starting their own thread pools in every forked worker. The variable
+    # is restored afterwards, tokenizing in this process stays parallel
+    parallelism = os.environ.get("TOKENIZERS_PARALLELISM")
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    try:
+        with multiprocessing.Pool(
+            num_workers,
+            initializer=_init_featurization_worker,
+            initargs=(tokenizer, kwargs),
+        ) as pool:
+            # imap yields the shards in submission order
+            return [
+                feature
+                for shard in pool.imap(_convert_shard, shards)
+                for feature in shard
+            ]
+    finally:
+        if parallelism is None:
+            os.environ.pop("TOKENIZERS_PARALLELISM", None)
+
+
+# column -> dtype of the columnar feature cache. The sequence columns are
+# unpadded and stored back to back, example i spans offsets[i]:offsets[i + 1]
+SEQUENCE_COLUMNS = ("input_ids", "input_mask", "segment_ids")
+FEATURE_DTYPES = {
+    "input_ids": np.int32,
+    "input_mask": np.int8,
+    "segment_ids": np.int8,
+    "offsets": np.int64,
+    "label_a": np.int16,
+    "label_b": np.int16,
+    # example IDs as fixed width unicode, the width is set per unit
+    "guid": np.str_,
+}
+
+
+def features_to_columns(features, output_mode="classification"):
+    """Packs a list of `InputFeatures` into contiguous numpy columns."""
+    lengths = np.array([len(f.input_ids) for f in features], dtype=np.int64)
+    columns = {"offsets": np.concatenate([[0], np.cumsum(lengths)])}
+    for column in SEQUENCE_COLUMNS:
+        columns[column] = np.fromiter(
+            (value for f in features for value in getattr(f, column)),
+            dtype=FEATURE_DTYPES[column],
+            count=columns["offsets"][-1],
+        )
+    for column in ("label_a", "label_b"):
+        dtype = FEATURE_DTYPES[column]
+        if output_mode == "regression":
+            dtype = np.float32
+        columns[column] = np.array(
+            [getattr(f, column) for f in features], dtype=dtype
+        )
+    columns["guid"] = np.array([str(f.guid) for f in features], dtype=np.str_)
+    return columns
+
+
+class FeatureDataset(Dataset):
+    """Dataset over the columns of converted features.
+
+    The columns are either held in memory or memory-mapped from a feature
+    cache directory written by `save`. Memory-mapped columns are reopened
+    lazily in every process instead of being pickled, so DataLoader
+    workers share the page cache rather than copying the features.
+
+    Items are ``(input_ids, attention_mask, token_type_ids, labels_a,
+    labels_b, index)`` tuples. The sequences are unpadded, batch them with
+    `DynamicPaddingCollator`. `index` is the position of the item in the
+    dataset, to look up data aligned with it (see `LogitsStore`).
+    """
+
+    def __init__(
+        self,
+        columns: Optional[Dict[str, np.ndarray]] = None,
+        cache_dir: Optional[str] = None,
+        language: Optional[str] = None,
+    ):
+        self._columns = columns
+        self.cache_dir = cache_dir
+        self.language = language
+
+    @classmethod
+    def load(cls, cache_dir: str) -> "FeatureDataset":
+        meta = read_feature_cache_meta(cache_dir)
+        dataset = cls(cache_dir=cache_dir, language=meta.get("language"))
+        dataset.columns  # fail early on a broken cache
+        # the meta.json mtime is the last use for `evict_feature_cache`
+        os.utime(os.path.join(cache_dir, "meta.json"))
+        return dataset
+
+    @staticmethod
+    def concat(datasets: List["FeatureDataset"]) -> "ConcatFeatureDataset":
+        return ConcatFeatureDataset(datasets)
+
+    def save(self, cache_dir: str, **meta):
+        """Writes the columns as .npy files, atomically replacing `cache_dir`.
+
+        `meta` is stored in the meta.json of the entry.
+        """
+        tmp_dir = "{}.tmp-{}".format(cache_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        for column, values in self.columns.items():
+            np.save(os.path.join(tmp_dir, column + ".npy"), values)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(
+                {"num_features": len(self), "language": self.language, **meta},
+                f,
+            )
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        elif os.path.exists(cache_dir):
+            os.remove(cache_dir)  # torch.save'd list of older versions
+        os.rename(tmp_dir, cache_dir)
+        self.cache_dir = cache_dir
+
+    def column(self, name: str) -> np.ndarray:
+        if name == "lengths":
+            return np.diff(self.columns["offsets"])
+        if name == "language":
+            return np.full(len(self), self.language or "")
+        return self.columns[name]
+
+    @property
+    def columns(self) -> Dict[str, np.ndarray]:
+        if self._columns is None:
+            self._columns = {
+                column: np.load(
+                    os.path.join(self.cache_dir, column + ".npy"),
+                    mmap_mode="r",
                 )
+                for column in FEATURE_DTYPES
+            }
+        return self._columns
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.cache_dir is not None:
+            state["_columns"] = None
+        return state
+
+    def __len__(self):
+        return len(self.columns["label_a"])
+
+    def __getitem__(self, index):
+        columns = self.columns
+        start, end = columns["offsets"][index : index + 2]
+        label_dtype = (
+            torch.float
+            if columns["label_a"].dtype == np.float32
+            else torch.long
+        )
+        return tuple(
+            torch.from_numpy(columns[column][start:end].astype(np.int64))
+            for column in SEQUENCE_COLUMNS
+        ) + (
+            torch.tensor(columns["label_a"][index], dtype=label_dtype),
+            torch.tensor(columns["label_b"][index], dtype=label_dtype),
+            torch.tensor(index, dtype=torch.long),
+        )
+
+
+class ConcatFeatureDataset(ConcatDataset):
+    """Several `FeatureDataset` units (one per language and split) served
+    as one dataset. The units keep their own, possibly memory-mapped,
+    columns; nothing is copied when they are assembled.
+    """
+
+    @property
+    def languages(self) -> List[Optional[str]]:
+        return [dataset.language for dataset in self.datasets]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        # the index of the item in the unit -> in the concatenated dataset
+        return super().__getitem__(index)[:-1] + (
+            torch.tensor(index, dtype=torch.long),
+        )
+
+    def column(self, name: str) -> np.ndarray:
+        """`name` column of all units, concatenated (copies)."""
+        return np.concatenate(
+            [dataset.column(name) for dataset in self.datasets]
+        )
+
+
+class LogitsStore(object):
+    """Outputs of a model over one split, written by `run_classification.py
+    --do_cache_logits`: the memory-mapped ``logits_a``, ``logits_b`` and
+    optionally ``pooled`` arrays, whose row i belongs to the example
+    ``guid[i]`` of ``language[i]``.
+    """
+
+    ARRAYS = ("logits_a", "logits_b", "pooled", "guid", "language")
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.arrays = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            for name in self.ARRAYS
+            if os.path.exists(os.path.join(path, name + ".npy"))
+        }
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.arrays
+
+    def rows(self, guids, languages) -> np.ndarray:
+        """The rows of the examples (`guids`, `languages`), e.g. of a
+        `FeatureDataset`. Raises KeyError if one is not stored."""
+        index = {
+            key: row
+            for row, key in enumerate(
+                zip(self.arrays["language"].tolist(), self.arrays["guid"].tolist())
+            )
+        }
+        try:
+            return np.array(
+                [
+                    index[key]
+                    for key in zip(
+                        np.asarray(languages).tolist(),
+                        np.asarray(guids).tolist(),
+                    )
+                ],
+                dtype=np.int64,
             )
-            logger.info("label: {} (id = {})".format(example.label, label_id))
-
-        features.append(
-            InputFeatures(
-                input_ids=input_ids,
-                input_mask=attention_mask,
-                segment_ids=segment_ids,
-                label_a=label_a,
-                label_b=label_b,
+        except KeyError as ex:
+            raise KeyError(
+                "example {} is not in the logits store {}".format(ex, self.path)
+            )
+
+    def aligned(self, dataset, names=("logits_a", "logits_b")):
+        """`names` arrays ordered like the examples of `dataset`."""
+        rows = self.rows(dataset.column("guid"), dataset.column("language"))
+        return {name: np.asarray(self.arrays[name][rows]) for name in names}
+
+
+class DynamicPaddingCollator(object):
+    """Batches `FeatureDataset` items, padding the sequences only to the
+    longest sequence of the batch."""
+
+    def __init__(self, pad_token_id=0, pad_token_segment_id=0):
+        self.pad_values = (pad_token_id, 0, pad_token_segment_id)
+
+    def __call__(self, batch):
+        fields = list(zip(*batch))
+        max_length = max(len(sequence) for sequence in fields[0])
+        padded = []
+        for sequences, pad_value in zip(fields, self.pad_values):
+            tensor = torch.full(
+                (len(sequences), max_length), pad_value, dtype=torch.long
             )
+            for row, sequence in enumerate(sequences):
+                tensor[row, : len(sequence)] = sequence
+            padded.append(tensor)
+        return tuple(padded) + tuple(
+            torch.stack(values) for values in fields[len(self.pad_values) :]
         )
-    return features
+
+
+class DevicePrefetcher(object):
+    """Iterates over `dataloader`, moving every batch to `device`.
+
+    With `prefetch` > 0 a background thread fetches and transfers up to that
+    many batches ahead of the loop consuming them (on CUDA on a side
+    stream), so input and compute overlap. `wait_time` adds up the seconds
+    the consumer spent waiting for batches.
+    """
+
+    def __init__(self, dataloader, device, prefetch=0, non_blocking=False):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.prefetch = prefetch
+        self.non_blocking = non_blocking
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _to_device(self, batch):
+        return tuple(
+            t.to(self.device, non_blocking=self.non_blocking) for t in batch
+        )
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            iterator = iter(self.dataloader)
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = self._to_device(next(iterator))
+                except StopIteration:
+                    return
+                finally:
+                    self.wait_time += time.perf_counter() - start
+                yield batch
+        else:
+            yield from self._prefetched()
+
+    def _prefetched(self):
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        stream = (
+            torch.cuda.Stream(self.device)
+            if self.device.type == "cuda"
+            else None
+        )
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def worker():
+            try:
+                for batch in self.dataloader:
+                    if stream is not None:
+                        with torch.cuda.stream(stream):
+                            batch = self._to_device(batch)
+                    else:
+                        batch = self._to_device(batch)
+                    put(batch)
+                    if stop.is_set():
+                        return
+                put(end)
+            except Exception as ex:  # re-raised in the consuming thread
+                put(ex)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = batches.get()
+                self.wait_time += time.perf_counter() - start
+                if batch is end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                if stream is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_stream(stream)
+                    for t in batch:
+                        t.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+class LengthGroupedSampler(Sampler):
+    """Shuffles the dataset, then groups examples of similar length.
+
+    Shuffled indices are cut into mega-batches of `mega_batch_mult` global
+    batches, sorted by length inside each mega-batch and split into global
+    batches of ``batch_size * num_replicas``, whose order is shuffled again.
+    Like `DistributedSampler`, every replica gets an interleaved share of
+    each global batch, so the replicas see batches of similar length at the
+    same step. Call `set_epoch` to get a different order every epoch.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        num_replicas=None,
+        rank=None,
+        shuffle=True,
+        seed=0,
+        mega_batch_mult=50,
+    ):
+        if num_replicas is None:
+            num_replicas = (
+                torch.distributed.get_world_size()
+                if torch.distributed.is_initialized()
+                else 1
+            )
+        if rank is None:
+            rank = (
+                torch.distributed.get_rank()
+                if torch.distributed.is_initialized()
+                else 0
+            )
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.mega_batch_mult = mega_batch_mult
+        self.epoch = 0
+        self.num_samples = -(-len(self.lengths) // self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = np.random.RandomState(self.seed + self.epoch)
+        indices = (
+            generator.permutation(len(self.lengths))
+            if self.shuffle
+            else np.arange(len(self.lengths))
+        )
+        # pad to an even share per replica, as DistributedSampler does
+        indices = np.resize(indices, self.total_size)
+
+        global_batch_size = self.batch_size * self.num_replicas
+        mega_batch_size = global_batch_size * self.mega_batch_mult
+        batches = []
+        for start in range(0, len(indices), mega_batch_size):
+            mega_batch = indices[start : start + mega_batch_size]
+            mega_batch = mega_batch[
+                np.argsort(-self.lengths[mega_batch], kind="stable")
+            ]
+            batches.extend(
+                mega_batch[i : i + global_batch_size]
+                for i in range(0, len(mega_batch), global_batch_size)
+            )
+        if self.shuffle:
+            # only the last batch can be short, keep it last so that every
+            # other global batch stays aligned across the replicas
+            order = generator.permutation(len(batches) - 1).tolist()
+            batches = [batches[i] for i in order] + batches[-1:]
+        indices = np.concatenate(batches)
+        return iter(indices[self.rank :: self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Yields batches of indices holding at most `max_tokens` tokens once
+    padded to their longest sequence, instead of a fixed number of examples.
+
+    With `shuffle`, examples are sorted by length (ties broken at random)
+    before packing, so the number of batches is the same every epoch and
+    the learning rate schedule can be computed up front. Consecutive
+    batches, which have similar lengths, form one global step across the
+    `num_replicas` replicas and the order of the steps is shuffled.
+    Without `shuffle` the dataset order is kept, as evaluation needs.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        max_tokens,
+        num_replicas=None,
+        rank=None,
+        shuffle=True,
+        seed=0,
+    ):
+        if num_replicas is None:
+            num_replicas = (
+                torch.distributed.get_world_size()
+                if torch.distributed.is_initialized()
+                else 1
+            )
+        if rank is None:
+            rank = (
+                torch.distributed.get_rank()
+                if torch.distributed.is_initialized()
+                else 0
+            )
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = -(-len(self._batches()) // self.num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self, generator=None):
+        if generator is None:
+            indices = (
+                np.argsort(self.lengths, kind="stable")
+                if self.shuffle
+                else np.arange(len(self.lengths))
+            )
+        else:
+            indices = np.lexsort(
+                (generator.random_sample(len(self.lengths)), self.lengths)
+            )
+        batches, batch, batch_max_length = [], [], 0
+        for index in indices.tolist():
+            length = self.lengths[index]
+            if batch and max(batch_max_length, length) * (
+                len(batch) + 1
+            ) > self.max_tokens:
+                batches.append(batch)
+                batch, batch_max_length = [], 0
+            batch.append(index)
+            batch_max_length = max(batch_max_length, length)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        generator = np.random.RandomState(self.seed + self.epoch)
+        batches = self._batches(generator if self.shuffle else None)
+        # pad to an even share per replica, as DistributedSampler does
+        total_batches = self.num_batches * self.num_replicas
+        batches = [batches[i % len(batches)] for i in range(total_batches)]
+        steps = [
+            batches[i : i + self.num_replicas]
+            for i in range(0, total_batches, self.num_replicas)
+        ]
+        if self.shuffle:
+            steps = [steps[i] for i in generator.permutation(len(steps))]
+        return iter([step[self.rank] for step in steps])
+
+    def __len__(self):
+        return self.num_batches
+
+
+class SkipBatchSampler(Sampler):
+    """Yields the batches of `batch_sampler` after the first `skip`.
+
+    Resumes an epoch in the middle: the skipped batches are only drawn as
+    indices, never fetched, collated or moved to the device. Reset `skip`
+    to 0 once the epoch is over (worker-based DataLoaders may iterate the
+    sampler more than once per epoch).
+    """
+
+    def __init__(self, batch_sampler, skip=0):
+        self.batch_sampler = batch_sampler
+        self.skip = skip
+
+    def set_epoch(self, epoch):
+        # a torch BatchSampler has no set_epoch, its sampler shuffles
+        sampler = self.batch_sampler
+        if not hasattr(sampler, "set_epoch"):
+            sampler = getattr(sampler, "sampler", None)
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batch_sampler), self.skip, None)
+
+    def __len__(self):
+        return len(self.batch_sampler) - self.skip
 
 
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):